@@ -1,20 +1,67 @@
 import io
 import re
 import base64
+import copy
+import gzip
+import hashlib
 import logging
 import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 import json  # Added for image handling
-from typing import Dict, List, Optional, BinaryIO
+from collections import OrderedDict
+from typing import List, Optional, BinaryIO
+from xml.sax.saxutils import escape
 from dataclasses import dataclass
 from enum import Enum
-from flask import Flask, request, jsonify, abort, send_file
+from flask import (
+    Flask,
+    Response,
+    request,
+    jsonify,
+    abort,
+    send_file,
+)
 from docx import Document
 from docx.enum.text import WD_COLOR
+from docx.oxml import parse_xml
+from docx.text.run import Run
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
 from lxml import etree
 
 # Import image handler - add this line to your imports
 from docx_image_handler import DOCXImageHandler
 
+# Optional SIMD base64 codec; the stdlib module is used when it isn't installed
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Optional fast JSON parser; falls back to the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# python-docx's package writer, whose steps _save_document reuses; it isn't
+# public API, so a release that moves it falls back to document.save()
+try:
+    from docx.opc.pkgwriter import PackageWriter
+except ImportError:
+    PackageWriter = None
+
+# Optional ISA-L deflate for the DOCX parts _DocxZipWriter compresses
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
 # Configure logging
 log_level = os.environ.get("LOG_LEVEL", "INFO")
 logging.basicConfig(
@@ -23,6 +70,196 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Largest request body accepted, in bytes (larger uploads are rejected with 413)
+max_content_length = int(os.environ.get("MAX_CONTENT_LENGTH", 64 * 1024 * 1024))
+
+# Highlight color applied by {{HIGHLIGHT_START}}, resolved once
+_HIGHLIGHT_COLOR = WD_COLOR.YELLOW
+
+# Number of formatted documents kept in memory, keyed by input hash (0, the
+# default, disables the cache)
+format_cache_size = int(os.environ.get("FORMAT_CACHE_SIZE", 0))
+
+# Upper bound on the total size of the cached documents, in bytes
+format_cache_max_bytes = int(
+    os.environ.get("FORMAT_CACHE_MAX_BYTES", 128 * 1024 * 1024)
+)
+
+# Read size used when hashing an upload for the cache
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# WordprocessingML namespace and the Clark-notation tags used while rebuilding
+W_NS_URI = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+W_NS = f"{{{W_NS_URI}}}"
+W_P = f"{W_NS}p"
+W_R = f"{W_NS}r"
+W_T = f"{W_NS}t"
+W_BR = f"{W_NS}br"
+W_RPR = f"{W_NS}rPr"
+W_TAB = f"{W_NS}tab"
+W_TBL = f"{W_NS}tbl"
+W_TR = f"{W_NS}tr"
+W_TC = f"{W_NS}tc"
+W_SDT = f"{W_NS}sdt"
+W_SDT_CONTENT = f"{W_NS}sdtContent"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+# Fixed parts of the /format-xml responses; only the content/message varies
+_XML_SUCCESS_PREFIX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<response>
+    <status>success</status>
+    <message>Document formatted successfully</message>
+    <document>
+        <contentType>application/vnd.openxmlformats-officedocument.wordprocessingml.document</contentType>
+        <encoding>base64</encoding>
+        <content>"""
+_XML_SUCCESS_SUFFIX = b"""</content>
+    </document>
+</response>"""
+_XML_ERROR_PREFIX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<response>
+    <status>error</status>
+    <message>"""
+_XML_ERROR_SUFFIX = b"""</message>
+</response>"""
+
+# Run children that can be redistributed when a run is split by markers
+_SPLITTABLE_RUN_CHILDREN = frozenset(
+    (W_RPR, W_T, W_TAB, W_BR, f"{W_NS}cr", f"{W_NS}lastRenderedPageBreak")
+)
+
+
+def _b64encode(data) -> bytes:
+    """Base64-encode bytes or a buffer to ASCII bytes"""
+    if pybase64 is not None:
+        return pybase64.b64encode(data)
+    return base64.b64encode(data)
+
+
+def _b64encode_str(data) -> str:
+    """Base64-encode bytes or a buffer straight to str"""
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode("ascii")
+
+
+def _json_loads(data):
+    """Parse JSON from bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_response(obj, status: int = 200) -> Response:
+    """JSON response serialized with orjson when available"""
+    if orjson is not None:
+        return Response(
+            orjson.dumps(obj, option=orjson.OPT_SORT_KEYS),
+            status=status,
+            mimetype="application/json",
+        )
+    response = jsonify(obj)
+    response.status_code = status
+    return response
+
+
+def _b64decode(data) -> bytes:
+    """Decode base64 text (str or bytes) to bytes"""
+    if pybase64 is not None:
+        return pybase64.b64decode(data)
+    return base64.b64decode(data)
+
+
+# Media that is already compressed; deflating it again only costs time
+STORED_MEDIA_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "gif", "webp"})
+
+
+class _DocxZipWriter:
+    """
+    Physical package writer used by _save_document.
+
+    Same interface as python-docx's zip writer (write/close), except that
+    already-compressed media is stored instead of being deflated again, and
+    the rest is deflated with ISA-L when isal is installed.
+    """
+
+    def __init__(self, pkg_file: BinaryIO):
+        self._zipf = zipfile.ZipFile(pkg_file, "w", compression=zipfile.ZIP_DEFLATED)
+        self._date_time = time.localtime()[:6]
+
+    def write(self, pack_uri, blob: bytes) -> None:
+        info = zipfile.ZipInfo(pack_uri.membername, self._date_time)
+        info.external_attr = 0o600 << 16
+        if pack_uri.ext.lower() in STORED_MEDIA_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        if info.compress_type == zipfile.ZIP_STORED or isal_zlib is None:
+            self._zipf.writestr(info, blob)
+            return
+
+        # zipfile has no public hook for the compressor, so hand this one
+        # entry an ISA-L raw-deflate compressor instead of patching zipfile.zlib.
+        # The entry's writer only creates its compressor in __init__ and first
+        # uses it in write(); if that internal ever goes away, the stdlib
+        # compressor is kept.
+        info.file_size = len(blob)
+        with self._zipf.open(info, "w") as dst:
+            if getattr(dst, "_compressor", None) is not None:
+                dst._compressor = isal_zlib.compressobj(
+                    isal_zlib.Z_DEFAULT_COMPRESSION, isal_zlib.DEFLATED, -15
+                )
+            dst.write(blob)
+
+    def close(self) -> None:
+        self._zipf.close()
+
+
+# PackageWriter internals _save_document drives
+_PACKAGE_WRITER_STEPS = (
+    "_write_content_types_stream",
+    "_write_pkg_rels",
+    "_write_parts",
+)
+
+
+def _save_document(document: Document, stream: BinaryIO) -> None:
+    """Equivalent of document.save(stream), written through _DocxZipWriter"""
+    if PackageWriter is None or not all(
+        hasattr(PackageWriter, step) for step in _PACKAGE_WRITER_STEPS
+    ):
+        document.save(stream)
+        return
+
+    package = document.part.package
+    parts = package.parts
+    for part in parts:
+        part.before_marshal()
+    writer = _DocxZipWriter(stream)
+    PackageWriter._write_content_types_stream(writer, parts)
+    PackageWriter._write_pkg_rels(writer, package.rels)
+    PackageWriter._write_parts(writer, parts)
+    writer.close()
+
+
+def _has_zlib_header(data: bytes) -> bool:
+    """True if data starts with a valid zlib (RFC 1950) header"""
+    return (
+        len(data) >= 2
+        and data[0] & 0x0F == zlib.DEFLATED
+        and (data[0] << 8 | data[1]) % 31 == 0
+    )
+
+
+# Image placeholders reported by /test-doc-markers, e.g. {{IMAGE:chart_1}}
+_IMAGE_MARKER_PATTERN = re.compile(r"\{\{IMAGE:([^}]+)\}\}")
+
+# Compiled once: every paragraph below an element, including table cells
+_XP_PARAGRAPHS = etree.XPath(".//w:p", namespaces={"w": W_NS_URI})
+
+# Compiled once: line breaks inside a run (used by /test-linebreaks)
+_XP_BREAKS = etree.XPath(".//w:br", namespaces={"w": W_NS_URI})
+
 
 class FormatType(Enum):
     """Enum for supported format types"""
@@ -31,6 +268,12 @@ class FormatType(Enum):
     BOLD = "bold"
 
 
+# Formatting state while rebuilding a paragraph is an int bitmask of these
+BOLD_BIT = 1
+HIGHLIGHT_BIT = 2
+_FORMAT_BITS = {FormatType.BOLD: BOLD_BIT, FormatType.HIGHLIGHT: HIGHLIGHT_BIT}
+
+
 @dataclass
 class FormatMarker:
     """Data class for format markers"""
@@ -74,6 +317,13 @@ class DOCXFormatter:
 
     def __init__(self):
         self._compile_patterns()
+        self._build_run_templates()
+
+        # LRU of input digest -> formatted bytes; waitress serves from threads
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self.image_handler = DOCXImageHandler()
         logger.info(
             f"DOCXFormatter initialized with markers: {[m.start for m in self.MARKERS]}"
         )
@@ -87,15 +337,52 @@ class DOCXFormatter:
         self.start_markers = {m.start: m.type for m in self.MARKERS}
         self.end_markers = {m.end: m.type for m in self.MARKERS}
 
-        # Debug: Test the pattern
-        test_text = "Test {{BOLD_START}}bold{{BOLD_END}} text"
-        test_parts = self.marker_pattern.split(test_text)
-        logger.debug(f"Pattern test - Input: {test_text}")
-        logger.debug(f"Pattern test - Parts: {test_parts}")
-        logger.debug(
-            f"Pattern test - Expected: ['Test ', '{{BOLD_START}}', 'bold', '{{BOLD_END}}', ' text']"
+        # Marker -> (bits to set, bits to keep), one dict lookup per marker hit:
+        # a start marker ORs its bit in, an end marker masks it out, and either
+        # is applied as (state | set) & keep without branching
+        self.marker_actions = {
+            m.start: (_FORMAT_BITS[m.type], ~0) for m in self.MARKERS
+        }
+        self.marker_actions.update(
+            {m.end: (0, ~_FORMAT_BITS[m.type]) for m in self.MARKERS}
+        )
+
+        # Prefix shared by every marker ("{{"), used to reject plain text cheaply
+        self.marker_prefix = os.path.commonprefix(
+            list(self.start_markers) + list(self.end_markers)
         )
 
+        # Debug: Test the pattern
+        if logger.isEnabledFor(logging.DEBUG):
+            test_text = "Test {{BOLD_START}}bold{{BOLD_END}} text"
+            test_parts = self.marker_pattern.split(test_text)
+            logger.debug(f"Pattern test - Input: {test_text}")
+            logger.debug(f"Pattern test - Parts: {test_parts}")
+            logger.debug(
+                f"Pattern test - Expected: ['Test ', '{{BOLD_START}}', 'bold', '{{BOLD_END}}', ' text']"
+            )
+
+    def _build_run_templates(self) -> None:
+        """
+        Pre-build one text run and one line-break run per formatting bitmask.
+
+        _create_xml_run and _create_xml_line_break deep-copy these instead of
+        assembling rPr/b/highlight with SubElement for every run.
+        """
+        self._run_templates = {}
+        self._break_templates = {}
+        for state in range((BOLD_BIT | HIGHLIGHT_BIT) + 1):
+            props = ("<w:b/>" if state & BOLD_BIT else "") + (
+                '<w:highlight w:val="yellow"/>' if state & HIGHLIGHT_BIT else ""
+            )
+            rpr = f"<w:rPr>{props}</w:rPr>" if props else ""
+            self._run_templates[state] = etree.fromstring(
+                f'<w:r xmlns:w="{W_NS_URI}">{rpr}<w:t/></w:r>'
+            )
+            self._break_templates[state] = etree.fromstring(
+                f'<w:r xmlns:w="{W_NS_URI}">{rpr}<w:br/></w:r>'
+            )
+
     def format_document(self, input_stream: BinaryIO) -> BinaryIO:
         """
         Main method to format a DOCX document.
@@ -113,6 +400,73 @@ class DOCXFormatter:
         Returns:
             Binary stream of formatted DOCX file
         """
+        key = None
+        if format_cache_size > 0:
+            key = self._digest_stream(input_stream)
+            with self._cache_lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+            if cached is not None:
+                logger.info("Returning cached result for identical input document")
+                return io.BytesIO(cached)
+
+        # Package can't contain a marker: skip the python-docx load entirely
+        if not self._may_contain_markers(input_stream):
+            logger.info("No formatting markers in document; returning it unchanged")
+            return self._unchanged_result(input_stream, key)
+
+        document = self._open_document(input_stream)
+
+        # Process all paragraphs in the document
+        processed_count = self._process_all_paragraphs(document)
+        logger.info(f"Processed {processed_count} paragraphs with formatting markers")
+
+        # Nothing was rewritten: return the original package instead of paying
+        # for python-docx to serialize and deflate every part again
+        if processed_count == 0:
+            return self._unchanged_result(input_stream, key)
+
+        output_stream = io.BytesIO()
+        _save_document(document, output_stream)
+        if key is not None:
+            self._cache_result(key, output_stream.getvalue())
+        output_stream.seek(0)
+        return output_stream
+
+    def format_and_add_images(self, input_stream: BinaryIO, images: List) -> BinaryIO:
+        """
+        Format a DOCX document and insert images at their {{IMAGE:...}} markers.
+
+        Both steps run on the same loaded document, so the package is parsed
+        and zipped once instead of being saved by the formatter and then
+        unpacked and repacked by the image handler.
+
+        Args:
+            input_stream: Binary stream of input DOCX file
+            images: List of image dictionaries (see DOCXImageHandler)
+
+        Returns:
+            Binary stream of formatted DOCX file with images
+        """
+        if not images:
+            return self.format_document(input_stream)
+
+        document = self._open_document(input_stream)
+
+        processed_count = self._process_all_paragraphs(document)
+        logger.info(f"Processed {processed_count} paragraphs with formatting markers")
+
+        self.image_handler.add_images_to_document(document, images)
+
+        output_stream = io.BytesIO()
+        _save_document(document, output_stream)
+        output_stream.seek(0)
+        return output_stream
+
+    def _open_document(self, input_stream: BinaryIO) -> Document:
+        """Load a DOCX package with python-docx from the start of a stream"""
+        input_stream.seek(0)
         try:
             document = Document(input_stream)
         except Exception as e:
@@ -123,15 +477,96 @@ class DOCXFormatter:
         if logger.level == logging.DEBUG:
             self._debug_document_structure(document)
 
-        # Process all paragraphs in the document
-        processed_count = self._process_all_paragraphs(document)
-        logger.info(f"Processed {processed_count} paragraphs with formatting markers")
+        return document
 
-        # Save and return the formatted document
-        output_stream = io.BytesIO()
-        document.save(output_stream)
-        output_stream.seek(0)
-        return output_stream
+    def _digest_stream(self, input_stream: BinaryIO) -> bytes:
+        """Cache key for an upload, hashed in chunks and rewound afterwards"""
+        digest = hashlib.blake2b(digest_size=16)
+        input_stream.seek(0)
+        for chunk in iter(lambda: input_stream.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        input_stream.seek(0)
+        return digest.digest()
+
+    def _unchanged_result(self, input_stream: BinaryIO, key: Optional[bytes]):
+        """Copy the input package into the returned stream (and the cache)"""
+        input_stream.seek(0)
+        result = input_stream.read()
+        if key is not None:
+            self._cache_result(key, result)
+        return io.BytesIO(result)
+
+    def _may_contain_markers(self, input_stream: BinaryIO) -> bool:
+        """
+        Preflight the raw package before handing it to python-docx.
+
+        Returns False only when the parts that get processed (main document,
+        headers, footers) cannot hold a marker. Markers can be split across
+        runs, so this looks for the first character of the marker prefix (or
+        a character reference that might encode it) rather than whole markers.
+        Anything unexpected returns True and is left to the full load, which
+        also keeps its error reporting for broken or non-Word files; that
+        includes a processed part that isn't well-formed XML.
+        """
+        first = self.marker_prefix[:1].encode()
+        # Built per call: lxml parsers aren't shared between threads
+        parser = etree.XMLParser(resolve_entities=False)
+        try:
+            input_stream.seek(0)
+            with zipfile.ZipFile(input_stream) as z:
+                main_parts = self._related_parts(z, "", (RT.OFFICE_DOCUMENT,))
+                if len(main_parts) != 1:
+                    return True
+                main = main_parts[0]
+
+                content_types = etree.fromstring(z.read("[Content_Types].xml"))
+                if not any(
+                    el.get("PartName") == f"/{main}"
+                    and el.get("ContentType") == CT.WML_DOCUMENT_MAIN
+                    for el in content_types.iterchildren("{*}Override")
+                ):
+                    return True
+
+                parts = [main] + self._related_parts(z, main, (RT.HEADER, RT.FOOTER))
+                for name in parts:
+                    xml = z.read(name)
+                    if first in xml or b"&#" in xml:
+                        return True
+                    # Returned unchanged only if python-docx could load it too
+                    etree.fromstring(xml, parser)
+        except Exception:
+            # Fail open (bad zip, missing part or Target, unsupported or
+            # encrypted entry, ...): _open_document decides what's invalid
+            return True
+        return False
+
+    def _related_parts(self, z: zipfile.ZipFile, source: str, reltypes) -> List[str]:
+        """Zip names of internal parts related to source ("" = package) by reltypes"""
+        base = posixpath.dirname(source)
+        rels_name = posixpath.join(base, "_rels", f"{posixpath.basename(source)}.rels")
+        rels = etree.fromstring(z.read(rels_name))
+        return [
+            posixpath.normpath(posixpath.join("/", base, rel.get("Target")))[1:]
+            for rel in rels.iterchildren("{*}Relationship")
+            if rel.get("Type") in reltypes and rel.get("TargetMode") != "External"
+        ]
+
+    def _cache_result(self, key: bytes, result: bytes) -> None:
+        """Store a formatted document, evicting the least recently used"""
+        if len(result) > format_cache_max_bytes:
+            return
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache_bytes -= len(self._cache[key])
+            self._cache[key] = result
+            self._cache_bytes += len(result)
+            self._cache.move_to_end(key)
+            while (
+                len(self._cache) > format_cache_size
+                or self._cache_bytes > format_cache_max_bytes
+            ):
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
 
     def _debug_document_structure(self, document: Document) -> None:
         """Print debug information about document structure"""
@@ -145,8 +580,7 @@ class DOCXFormatter:
             logger.debug(f"Paragraph {i}: {repr(text)}")
 
         # Check for content controls in XML
-        w_ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
-        sdt_count = len(list(document._element.iter(f"{w_ns}sdt")))
+        sdt_count = len(list(document._element.iterdescendants(W_SDT)))
         logger.debug(f"Content controls (SDT) found: {sdt_count}")
         logger.debug("================================")
 
@@ -154,379 +588,242 @@ class DOCXFormatter:
         """Process all paragraphs including those in content controls"""
         processed_count = 0
 
-        # Process all paragraphs in the document
-        for paragraph in document.paragraphs:
-            if self._process_paragraph(paragraph):
-                processed_count += 1
-
-        # Process paragraphs in tables
-        for table in document.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        if self._process_paragraph(paragraph):
-                            processed_count += 1
-
-        # Process paragraphs in headers and footers
-        for section in document.sections:
-            # Header
-            if hasattr(section, "header") and section.header:
-                for paragraph in section.header.paragraphs:
-                    if self._process_paragraph(paragraph):
-                        processed_count += 1
-            # Footer
-            if hasattr(section, "footer") and section.footer:
-                for paragraph in section.footer.paragraphs:
-                    if self._process_paragraph(paragraph):
-                        processed_count += 1
-
-        # Special handling for content controls that might not be captured above
-        cc_processed = self._process_content_controls_special(document)
-        processed_count += cc_processed
+        # One compiled XPath per part finds every paragraph, including those in
+        # tables and block-level content controls, instead of walking
+        # paragraphs/tables/rows/cells wrappers
+        for root in self._paragraph_roots(document):
+            for para_elem in _XP_PARAGRAPHS(root):
+                if self._process_paragraph(para_elem):
+                    processed_count += 1
 
         return processed_count
 
-    def _process_content_controls(self, document: Document) -> None:
-        """Process paragraphs within plain text content controls"""
-        # Define Word namespaces
-        WORD_NAMESPACE = (
-            "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
-        )
-        ns = {"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
+    def _paragraph_roots(self, document: Document):
+        """
+        Yield the body plus the root of every header and footer part.
 
-        # Find all content control elements using full namespace
-        for sdt in document.element.xpath(f".//{WORD_NAMESPACE}sdt"):
-            # Find paragraphs within content controls
-            for para_elem in sdt.xpath(f".//{WORD_NAMESPACE}p"):
-                # Process this paragraph element
-                self._process_paragraph_element(para_elem, WORD_NAMESPACE)
+        Going through the document part's relationships covers first-page and
+        even-page headers/footers, visits parts shared by several sections only
+        once, and never creates a header definition for a section that has none.
+        """
+        yield document.element.body
+        for rel in document.part.rels.values():
+            if not rel.is_external and rel.reltype in (RT.HEADER, RT.FOOTER):
+                yield rel.target_part.element
 
-    def _process_paragraph(self, paragraph) -> bool:
-        """Process a single paragraph object. Returns True if processed."""
+    def _process_paragraph(self, para_elem) -> bool:
+        """Process a single <w:p> element. Returns True if processed."""
         try:
-            full_text = self._get_paragraph_text(paragraph)
-
-            # Skip if no markers found
-            if not self._has_markers(full_text):
-                return False
-
-            logger.debug(
-                f"Processing paragraph with markers: {repr(full_text[:50])}..."
-            )
-
-            # Check if paragraph has line breaks
-            has_breaks = False
-            for run in paragraph.runs:
-                run_elem = run._element
-                w_ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
-                br_elems = run_elem.findall(f".//{w_ns}br")
-                if br_elems:
-                    has_breaks = True
-                    logger.debug(
-                        f"Paragraph contains {len(br_elems)} line breaks in run"
-                    )
-
-            if has_breaks:
-                logger.debug("Using line-break-aware processing")
-
-            # Clear and rebuild runs
-            self._rebuild_paragraph_runs(paragraph, full_text)
-            return True
+            # Rebuild with lxml directly; paragraph.add_run and the python-docx
+            # run/font property setters cost several descriptor calls and element
+            # lookups per run. The marker check happens there too, in the same
+            # pass that collects the runs.
+            return self._process_xml_paragraph(para_elem)
         except Exception as e:
             logger.error(f"Error processing paragraph: {e}", exc_info=True)
             return False
 
-    def _process_paragraph_element(self, para_elem, namespace: str) -> None:
-        """Process a paragraph element (for content controls)"""
-        # Extract text from all runs in the paragraph
-        text_parts = []
-        for run_elem in para_elem.xpath(f"./{namespace}r"):
-            for text_elem in run_elem.xpath(f".//{namespace}t"):
-                if text_elem.text:
-                    text_parts.append(text_elem.text)
-
-        full_text = "".join(text_parts)
-
-        # Skip if no markers found
-        if not self._has_markers(full_text):
-            return
-
-        # Clear existing runs
-        for run_elem in list(para_elem.xpath(f"./{namespace}r")):
-            para_elem.remove(run_elem)
-
-        # Rebuild runs with formatting
-        self._rebuild_element_runs(para_elem, full_text)
+    def _iter_segments(self, text: str):
+        """
+        Tokenize text around format markers.
 
-    def _get_paragraph_text(self, paragraph) -> str:
-        """Extract all text from a paragraph"""
-        return "".join(run.text or "" for run in paragraph.runs)
+        Yields (literal, None) for text between markers and (None, action) for
+        each marker, where action is its (set bits, keep bits) entry from
+        marker_actions. Nothing is yielded for empty literals.
+        """
+        pos = 0
+        for match in self.marker_pattern.finditer(text):
+            start = match.start()
+            if start > pos:
+                yield text[pos:start], None
+            yield None, self.marker_actions[match.group(0)]
+            pos = match.end()
+        if pos < len(text):
+            yield text[pos:], None
 
     def _has_markers(self, text: str) -> bool:
         """Check if text contains any format markers"""
-        has_any = any(
-            marker.start in text or marker.end in text for marker in self.MARKERS
-        )
-        if has_any:
+        # Most paragraphs have no markers: a plain substring test rejects them
+        # without entering the regex engine
+        if self.marker_prefix not in text:
+            return False
+
+        # One pass with the precompiled alternation instead of 2 x len(MARKERS) scans
+        has_any = self.marker_pattern.search(text) is not None
+        if has_any and logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Text has markers: {text[:100]}...")
         return has_any
 
-    def _rebuild_paragraph_runs(self, paragraph, full_text: str) -> None:
+    def _process_xml_paragraph(self, para_elem) -> bool:
         """
-        Clear and rebuild paragraph runs with formatting, preserving line breaks.
-
-        This method:
-        1. Extracts the content sequence (text and line breaks) from the paragraph
-        2. Removes all existing runs
-        3. Processes text segments between line breaks, applying formatting based on markers
-        4. Re-inserts line breaks at their original positions
+        Process a paragraph element directly from XML, preserving line breaks.
 
-        This ensures that soft line breaks (Shift+Enter in Word) are preserved
-        while formatting markers are processed and removed.
+        Used for every paragraph with markers (body, tables, headers, footers and
+        content controls), ensuring that:
+        - Text formatting markers are processed and removed
+        - Line breaks (soft returns) are preserved
+        - The paragraph structure remains intact
         """
-        para_elem = paragraph._element
-        w_ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+        # Most paragraphs have no markers: reject them from their <w:t> text
+        # (a superset of what is rebuilt below) before walking the runs
+        if not self._has_markers("".join(para_elem.itertext(W_T, with_tail=False))):
+            return False
 
-        # Build an ordered sequence of content
+        # One pass over the direct <w:r> children collects the runs to drop,
+        # the ordered text/break sequence and the text used for marker detection
+        run_elems = []
         content_sequence = []
-        for run in paragraph.runs:
-            run_elem = run._element
-            # Get all elements in order
-            for child in run_elem.iter():
-                if child.tag == f"{w_ns}t" and child.text:
-                    content_sequence.append(("text", child.text))
-                elif child.tag == f"{w_ns}br":
+        texts = []
+        for run_elem in para_elem.iterchildren(W_R):
+            run_elems.append(run_elem)
+            # <w:t>/<w:br> are direct children of a run; don't descend into
+            # rPr or into text boxes nested in drawings
+            for elem in run_elem.iterchildren(W_T, W_BR):
+                if elem.tag == W_BR:
                     content_sequence.append(("break", None))
+                elif elem.text:
+                    content_sequence.append(("text", elem.text))
+                    texts.append(elem.text)
 
-        logger.debug(
-            f"Content sequence: {[(t, c[:20] if c else None) for t, c in content_sequence[:10]]}"
-        )
-
-        # Remove all run elements
-        for run_elem in list(para_elem.findall(f"{w_ns}r")):
-            para_elem.remove(run_elem)
+        full_text = "".join(texts)
 
-        # Rebuild from sequence
-        format_states = {fmt_type: False for fmt_type in FormatType}
-        current_text_buffer = []
-
-        for elem_type, content in content_sequence:
-            if elem_type == "text":
-                current_text_buffer.append(content)
-            elif elem_type == "break":
-                # Process buffered text
-                if current_text_buffer:
-                    combined_text = "".join(current_text_buffer)
-                    self._process_text_segment_runs(
-                        paragraph, combined_text, format_states
-                    )
-                    current_text_buffer = []
-
-                # Add line break
-                self._add_line_break_to_paragraph(paragraph, format_states)
-
-        # Process remaining text
-        if current_text_buffer:
-            combined_text = "".join(current_text_buffer)
-            self._process_text_segment_runs(paragraph, combined_text, format_states)
-
-    def _process_text_segment_runs(
-        self, paragraph, text: str, format_states: Dict[FormatType, bool]
-    ) -> None:
-        """Process a text segment for regular paragraphs"""
-        if not text:
-            return
-
-        parts = self.marker_pattern.split(text)
-
-        for part in parts:
-            if not part:
-                continue
-
-            if part in self.start_markers:
-                format_states[self.start_markers[part]] = True
-                logger.debug(f"Found start marker: {part}")
-                continue
-            elif part in self.end_markers:
-                format_states[self.end_markers[part]] = False
-                logger.debug(f"Found end marker: {part}")
-                continue
-            else:
-                logger.debug(f"Adding text run: '{part[:30]}...' with formatting")
-                run = paragraph.add_run(part)
-                self._apply_formatting(run, format_states)
-
-    def _add_line_break_to_paragraph(
-        self, paragraph, format_states: Dict[FormatType, bool]
-    ) -> None:
-        """Add a line break to a paragraph"""
-        run = paragraph.add_run()
-        self._apply_formatting(run, format_states)
-        run.add_break()  # This adds a <w:br/> element
-
-    def _rebuild_element_runs(self, para_elem, full_text: str) -> None:
-        """Rebuild runs for a paragraph element (used for content controls)"""
-        from docx.oxml import OxmlElement
-        from docx.oxml.ns import qn
-
-        parts = self.marker_pattern.split(full_text)
-        format_states = {fmt_type: False for fmt_type in FormatType}
-
-        for part in parts:
-            if not part:
-                continue
-
-            # Check if part is a marker
-            if part in self.start_markers:
-                format_states[self.start_markers[part]] = True
-            elif part in self.end_markers:
-                format_states[self.end_markers[part]] = False
-            else:
-                # Create new run element
-                run_elem = OxmlElement("w:r")
-                run_props = OxmlElement("w:rPr")
-
-                # Apply formatting
-                if format_states[FormatType.BOLD]:
-                    bold_elem = OxmlElement("w:b")
-                    run_props.append(bold_elem)
-
-                if format_states[FormatType.HIGHLIGHT]:
-                    highlight_elem = OxmlElement("w:highlight")
-                    highlight_elem.set(qn("w:val"), "yellow")
-                    run_props.append(highlight_elem)
-
-                if len(run_props):
-                    run_elem.append(run_props)
-
-                # Add text
-                text_elem = OxmlElement("w:t")
-                text_elem.text = part
-                # Preserve spaces if needed
-                if part.startswith(" ") or part.endswith(" "):
-                    text_elem.set(qn("xml:space"), "preserve")
-                run_elem.append(text_elem)
-
-                para_elem.append(run_elem)
-
-    def _process_content_controls_special(self, document: Document) -> int:
-        """
-        Special handling for content controls using XML manipulation.
-
-        Content controls can contain multiple paragraphs. This method ensures
-        all paragraphs within each content control are processed while preserving
-        their structure and line breaks.
-        """
-        # Access the document's XML
-        doc_xml = document._element
-
-        # Define namespace
-        w_ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
-
-        # Counter for content controls found
-        cc_count = 0
-        processed_paragraphs = 0
-
-        # Find all structured document tags (content controls)
-        for sdt in doc_xml.iter(f"{w_ns}sdt"):
-            cc_count += 1
-            logger.debug(f"Found content control #{cc_count}")
-
-            # Find the content element
-            sdt_content = sdt.find(f"{w_ns}sdtContent")
-            if sdt_content is None:
-                logger.debug(f"Content control #{cc_count} has no sdtContent element")
-                continue
+        # Skip if no markers found
+        if not self._has_markers(full_text):
+            return False
 
-            # Process all paragraphs within the content control
-            para_count = 0
-            paragraphs_in_cc = list(sdt_content.iter(f"{w_ns}p"))
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
-                f"Content control #{cc_count} contains {len(paragraphs_in_cc)} paragraphs"
+                f"Processing XML paragraph with markers: {repr(full_text[:50])}..."
+            )
+            logger.debug(
+                f"Content sequence ({len(content_sequence)} elements): {[(t, c[:20] if c else None) for t, c in content_sequence[:10]]}"
             )
 
-            for para_elem in paragraphs_in_cc:
-                para_count += 1
-                logger.debug(
-                    f"Processing paragraph {para_count} in content control #{cc_count}"
-                )
-                if self._process_xml_paragraph(para_elem, w_ns):
-                    processed_paragraphs += 1
+        # Markers that sit inside single runs can be stripped in place, which
+        # keeps each run's own properties (fonts, size, italic, tabs)
+        if self._strip_markers_in_place(para_elem, run_elems, full_text):
+            return True
 
-            if para_count == 0:
-                logger.debug(f"No paragraphs found in content control #{cc_count}")
+        # Remove all existing runs in one go
+        para_elem[:] = [child for child in para_elem if child.tag != W_R]
 
-        if cc_count > 0:
-            logger.info(
-                f"Found {cc_count} content controls, processed {processed_paragraphs} paragraphs with markers"
-            )
+        # Process the content sequence
+        self._rebuild_from_sequence(para_elem, content_sequence)
 
-        return processed_paragraphs
+        return True
 
-    def _process_xml_paragraph(self, para_elem, namespace: str) -> bool:
+    def _strip_markers_in_place(self, para_elem, run_elems, full_text: str) -> bool:
         """
-        Process a paragraph element directly from XML, preserving line breaks.
-
-        This method handles paragraphs within content controls, ensuring that:
-        - Text formatting markers are processed and removed
-        - Line breaks (soft returns) are preserved
-        - The paragraph structure remains intact
+        Remove markers from the existing runs instead of rebuilding them.
+
+        Each run keeps its own properties (fonts, size, italic, ...): a run whose
+        text has one formatting state is edited where it is, and a run whose
+        text changes state is split into copies of itself. Only possible when
+        no marker is split across <w:t> elements, and a run is only split if it
+        holds nothing but text, tabs and breaks. Returns False without touching
+        the tree otherwise, so the caller can rebuild the runs.
         """
-        # Build an ordered list of all content in the paragraph
-        content_sequence = []
-        run_elems = list(para_elem.findall(f"{namespace}r"))
-
-        # Log paragraph preview for debugging
-        para_text_preview = "".join(
-            elem.text or "" for elem in para_elem.iter(f"{namespace}t")
-        )[:100]
-        logger.debug(f"XML paragraph preview: {repr(para_text_preview)}")
-
-        # Process runs in order
-        for run_idx, run_elem in enumerate(run_elems):
-            # Get all child elements in document order
-            elements_in_run = []
-            for elem in run_elem.iter():
-                if elem.tag == f"{namespace}t" and elem.text:
-                    elements_in_run.append(("text", elem.text))
-                elif elem.tag == f"{namespace}br":
-                    elements_in_run.append(("break", None))
-
-            if elements_in_run:
-                logger.debug(f"Run {run_idx} contains: {elements_in_run}")
-
-            content_sequence.extend(elements_in_run)
-
-        # Build full text for marker detection (excluding breaks)
-        full_text = "".join(
-            content for elem_type, content in content_sequence if elem_type == "text"
-        )
+        plan = []
+        marker_count = 0
+        state = 0
+        for run_elem in run_elems:
+            # (state, text) for each literal piece, (state, element) for others
+            items = []
+            text_states = set()
+            for child in run_elem:
+                if child.tag == W_RPR:
+                    continue
+                if child.tag != W_T:
+                    items.append((state, child))
+                    continue
+                for piece, action in self._iter_segments(child.text or ""):
+                    if action is not None:
+                        marker_count += 1
+                        state = (state | action[0]) & action[1]
+                    else:
+                        items.append((state, piece))
+                        text_states.add(state)
+            if len(text_states) > 1 and any(
+                child.tag not in _SPLITTABLE_RUN_CHILDREN for child in run_elem
+            ):
+                return False
+            plan.append((run_elem, items, text_states))
 
-        # Skip if no markers found
-        if not self._has_markers(full_text):
+        # Fewer matches per <w:t> than in the joined text: a marker is split
+        if marker_count != len(self.marker_pattern.findall(full_text)):
             return False
 
-        logger.debug(
-            f"Processing XML paragraph with markers: {repr(full_text[:50])}..."
-        )
-        logger.debug(
-            f"Content sequence ({len(content_sequence)} elements): {[(t, c[:20] if c else None) for t, c in content_sequence[:10]]}"
-        )
+        for run_elem, items, text_states in plan:
+            if len(text_states) > 1:
+                self._split_run(run_elem, items)
+                continue
+            if text_states:
+                state = text_states.pop()
+            elif items:
+                # No text (a tab- or break-only run): it takes the formatting
+                # active where it sits, like a tab sharing a run with text
+                state = items[0][0]
+            else:
+                state = 0
+            self._strip_run_in_place(para_elem, run_elem, state)
 
-        # Remove all existing runs
-        for run_elem in run_elems:
+        return True
+
+    def _strip_run_in_place(self, para_elem, run_elem, state: int) -> None:
+        """Drop markers from a run's <w:t> elements and apply state to the run"""
+        for text_elem in list(run_elem.iterchildren(W_T)):
+            text = self.marker_pattern.sub("", text_elem.text or "")
+            if not text:
+                run_elem.remove(text_elem)
+                continue
+            text_elem.text = text
+            if text.startswith(" ") or text.endswith(" "):
+                text_elem.set(XML_SPACE, "preserve")
+
+        if len(run_elem) == 0 or (len(run_elem) == 1 and run_elem[0].tag == W_RPR):
+            # Run held nothing but markers
             para_elem.remove(run_elem)
+        else:
+            self._apply_run_state(run_elem, state)
+
+    def _split_run(self, run_elem, items) -> None:
+        """Replace a run with one copy of it per formatting state change"""
+        template = copy.deepcopy(run_elem)
+        template[:] = [child for child in template if child.tag == W_RPR]
+
+        new_runs = []
+        current_state = None
+        for state, item in items:
+            if state != current_state or not new_runs:
+                new_runs.append((copy.deepcopy(template), state))
+                current_state = state
+            new_run = new_runs[-1][0]
+            if isinstance(item, str):
+                text_elem = etree.SubElement(new_run, W_T)
+                text_elem.text = item
+                if item.startswith(" ") or item.endswith(" "):
+                    text_elem.set(XML_SPACE, "preserve")
+            else:
+                new_run.append(item)
 
-        # Process the content sequence
-        self._rebuild_from_sequence(para_elem, content_sequence, namespace)
+        for new_run, state in reversed(new_runs):
+            self._apply_run_state(new_run, state)
+            run_elem.addnext(new_run)
+        run_elem.getparent().remove(run_elem)
 
-        return True
+    def _apply_run_state(self, run_elem, state: int) -> None:
+        """Turn on bold/highlight for a state bitmask, leaving other rPr alone"""
+        if not state:
+            return
+        run = Run(run_elem, None)
+        if state & BOLD_BIT:
+            run.bold = True
+        if state & HIGHLIGHT_BIT:
+            run.font.highlight_color = _HIGHLIGHT_COLOR
 
-    def _rebuild_from_sequence(
-        self, para_elem, content_sequence, namespace: str
-    ) -> None:
+    def _rebuild_from_sequence(self, para_elem, content_sequence) -> None:
         """Rebuild paragraph from a sequence of text and break elements"""
-        format_states = {fmt_type: False for fmt_type in FormatType}
+        state = 0
         current_text_buffer = []
 
         for elem_type, content in content_sequence:
@@ -537,130 +834,100 @@ class DOCXFormatter:
                 # Process any buffered text first
                 if current_text_buffer:
                     combined_text = "".join(current_text_buffer)
-                    self._process_text_segment(
-                        para_elem, combined_text, format_states, namespace
-                    )
+                    state = self._process_text_segment(para_elem, combined_text, state)
                     current_text_buffer = []
 
                 # Add the line break
-                self._create_xml_line_break(para_elem, format_states, namespace)
+                self._create_xml_line_break(para_elem, state)
 
         # Process any remaining buffered text
         if current_text_buffer:
             combined_text = "".join(current_text_buffer)
-            self._process_text_segment(
-                para_elem, combined_text, format_states, namespace
-            )
+            self._process_text_segment(para_elem, combined_text, state)
 
-    def _process_text_segment(
-        self,
-        para_elem,
-        text: str,
-        format_states: Dict[FormatType, bool],
-        namespace: str,
-    ) -> None:
-        """Process a text segment, applying formatting based on markers"""
-        if not text:
-            return
-
-        # Split by markers
-        parts = self.marker_pattern.split(text)
-
-        for part in parts:
-            if not part:
-                continue
+    def _process_text_segment(self, para_elem, text: str, state: int) -> int:
+        """
+        Process a text segment, applying formatting based on markers.
 
-            # Check if part is a marker
-            if part in self.start_markers:
-                format_states[self.start_markers[part]] = True
-                logger.debug(f"Found start marker: {part}")
-                continue
-            elif part in self.end_markers:
-                # Before ending formatting, ensure any pending text is processed
-                format_states[self.end_markers[part]] = False
-                logger.debug(f"Found end marker: {part}")
+        Returns the formatting bitmask in effect after the segment.
+        """
+        if not text:
+            return state
+
+        # Text is buffered while the formatting stays the same, so pieces split
+        # by redundant markers (e.g. "{{BOLD_END}}{{BOLD_START}}") share one run.
+        pending = []
+        pending_state = state
+        for piece, action in self._iter_segments(text):
+            if action is not None:
+                state = (state | action[0]) & action[1]
                 continue
-            else:
-                # Create run with current formatting
-                logger.debug(
-                    f"Creating XML run: '{part[:30]}...' with bold={format_states.get(FormatType.BOLD)}, highlight={format_states.get(FormatType.HIGHLIGHT)}"
-                )
-                self._create_xml_run(para_elem, part, format_states, namespace)
-
-    def _create_xml_line_break(
-        self, para_elem, format_states: Dict[FormatType, bool], namespace: str
-    ) -> None:
-        """Create a line break element in XML"""
-        from lxml import etree
-
-        # Create run element for the line break
-        run_elem = etree.SubElement(para_elem, f"{namespace}r")
-
-        # Add run properties if formatting is active
-        if any(format_states.values()):
-            rPr = etree.SubElement(run_elem, f"{namespace}rPr")
-
-            if format_states.get(FormatType.BOLD, False):
-                etree.SubElement(rPr, f"{namespace}b")
-
-            if format_states.get(FormatType.HIGHLIGHT, False):
-                highlight = etree.SubElement(rPr, f"{namespace}highlight")
-                highlight.set(
-                    "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val",
-                    "yellow",
-                )
-
-        # Add line break element
-        etree.SubElement(run_elem, f"{namespace}br")
-
-    def _create_xml_run(
-        self,
-        para_elem,
-        text: str,
-        format_states: Dict[FormatType, bool],
-        namespace: str,
-    ) -> None:
-        """Create a formatted run in XML"""
-        from lxml import etree
 
-        # Create run element
-        run_elem = etree.SubElement(para_elem, f"{namespace}r")
+            if pending and pending_state != state:
+                self._create_xml_run(para_elem, "".join(pending), pending_state)
+                pending = []
+            if not pending:
+                pending_state = state
+            pending.append(piece)
 
-        # Add run properties if needed
-        if any(format_states.values()):
-            rPr = etree.SubElement(run_elem, f"{namespace}rPr")
+        if pending:
+            self._create_xml_run(para_elem, "".join(pending), pending_state)
+        return state
 
-            if format_states[FormatType.BOLD]:
-                etree.SubElement(rPr, f"{namespace}b")
+    def _create_xml_line_break(self, para_elem, state: int) -> None:
+        """Create a line break run in XML formatted according to the state bitmask"""
+        para_elem.append(copy.deepcopy(self._break_templates[state]))
 
-            if format_states[FormatType.HIGHLIGHT]:
-                highlight = etree.SubElement(rPr, f"{namespace}highlight")
-                highlight.set(f"{namespace}val", "yellow")
+    def _create_xml_run(self, para_elem, text: str, state: int) -> None:
+        """Create a run in XML formatted according to the state bitmask"""
+        # Copy the pre-built run for this state instead of assembling it node by node
+        run_elem = copy.deepcopy(self._run_templates[state])
 
         # Add text
-        text_elem = etree.SubElement(run_elem, f"{namespace}t")
+        text_elem = run_elem[-1]
         if text.startswith(" ") or text.endswith(" "):
             # Preserve spaces
-            text_elem.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+            text_elem.set(XML_SPACE, "preserve")
         text_elem.text = text
-
-    def _apply_formatting(self, run, format_states: Dict[FormatType, bool]) -> None:
-        """Apply formatting to a run based on current format states"""
-        if format_states.get(FormatType.BOLD, False):
-            run.bold = True
-            logger.debug(f"Applied bold to run: '{run.text}'")
-        if format_states.get(FormatType.HIGHLIGHT, False):
-            run.font.highlight_color = WD_COLOR.YELLOW
-            logger.debug(f"Applied highlight to run: '{run.text}'")
+        para_elem.append(run_elem)
 
 
 class DOCXFormatterAPI:
     """Flask API for DOCX formatting service"""
 
+    # Uploads up to this size stay in memory, larger ones spill to a temp file
+    UPLOAD_SPOOL_SIZE = 4 * 1024 * 1024
+
+    # Read/inflate granularity for Content-Encoding: gzip/deflate uploads
+    DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+    # Bytes of document base64-encoded per chunk of a streamed XML response
+    # (a multiple of 3, so chunks concatenate without padding)
+    XML_ENCODE_CHUNK_SIZE = 48 * 1024
+
+    # Media type required by the JSON endpoints (images, marker check)
+    JSON_CONTENT_TYPE = "application/json"
+
+    # Media types accepted by /format
+    VALID_CONTENT_TYPES = frozenset(
+        {
+            "application/octet-stream",
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            "multipart/form-data",  # For browser uploads
+            "application/json",  # For JSON requests with images
+        }
+    )
+
     def __init__(self):
         self.app = Flask(__name__)
+        self.app.config["MAX_CONTENT_LENGTH"] = max_content_length
         self.formatter = DOCXFormatter()
-        self.image_handler = DOCXImageHandler()  # Add image handler
+        self.image_handler = self.formatter.image_handler
+
+        # The test documents are fixed, so build them once and serve the bytes
+        self._test_images_docx = self._build_test_images_docx()
+        self._test_markers_docx = self._build_test_markers_docx()
+
         self._setup_routes()
 
     def _setup_routes(self):
@@ -696,30 +963,28 @@ class DOCXFormatterAPI:
         """Main formatting endpoint"""
         logger.info("Received formatting request")
 
-        # Validate request
-        if not request.data:
-            logger.warning("Empty request body")
-            return abort(400, "Request body is empty. Please upload a .docx file.")
-
+        # Validate request; the media type first, so a rejected upload is
+        # never read or decompressed
         content_type = request.headers.get("Content-Type", "")
         if not self._is_valid_content_type(content_type):
             logger.warning(f"Invalid Content-Type: {content_type}")
             return abort(415, f"Unsupported Media Type: {content_type}")
 
+        upload = self._spool_request_body()
+        if upload is None:
+            logger.warning("Empty request body")
+            return abort(400, "Request body is empty. Please upload a .docx file.")
+
         try:
             # Process document
-            input_stream = io.BytesIO(request.data)
-            output_stream = self.formatter.format_document(input_stream)
+            with upload:
+                output_stream = self.formatter.format_document(upload)
 
-            # Read output for base64 encoding
-            output_data = output_stream.read()
-            output_stream.seek(0)
-
-            # Return response in requested format
+            # Encode straight from the stream's buffer; no intermediate bytes copy
             response_data = {
                 "body": {
                     "$content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    "$content": base64.b64encode(output_data).decode("utf-8"),
+                    "$content": _b64encode_str(output_stream.getbuffer()),
                 }
             }
 
@@ -739,7 +1004,7 @@ class DOCXFormatterAPI:
 
         # Check Content-Type
         content_type = request.headers.get("Content-Type", "")
-        if not content_type.startswith("application/json"):
+        if not content_type.startswith(self.JSON_CONTENT_TYPE):
             logger.warning(
                 f"Invalid Content-Type for /format-with-images: {content_type}"
             )
@@ -754,10 +1019,10 @@ class DOCXFormatterAPI:
                 415,
             )
 
-        try:
-            # Get JSON data from request
-            data = request.get_json()
+        # Get JSON data from request (outside the try so a 413 isn't a 500)
+        data = self._read_json_body()
 
+        try:
             if not data:
                 return (
                     jsonify(
@@ -785,35 +1050,25 @@ class DOCXFormatterAPI:
                     400,
                 )
 
-            # Debug logging
-            logger.debug(f"Received data keys: {list(data.keys())}")
-            if "body" in data:
-                logger.debug(f"Body keys: {list(data['body'].keys())}")
-                if "images" in data["body"]:
-                    logger.debug(
-                        f"Number of images in body: {len(data['body']['images'])}"
-                    )
-
-            # Extract document and images
-            # Support multiple formats for flexibility
-            doc_content = None
-            images = []
+            body = data.get("body") if isinstance(data, dict) else None
+            body_is_dict = isinstance(body, dict)
 
-            # Format 1: Body structure with images inside body (NEW FORMAT)
-            if "body" in data and isinstance(data["body"], dict):
-                doc_content = data["body"].get("$content")
-                images = data["body"].get("images", [])
-            elif "document" in data:  # legacy support
+            # Debug logging
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received data keys: {list(data)}")
+                if body_is_dict:
+                    logger.debug(f"Body keys: {list(body)}")
+                    if "images" in body:
+                        logger.debug(f"Number of images in body: {len(body['images'])}")
+
+            # Extract document and images: body.$content with body.images (NEW
+            # FORMAT, root-level images also accepted) or legacy root "document"
+            if body_is_dict:
+                doc_content = body.get("$content")
+                images = body.get("images") or data.get("images") or []
+            else:
                 doc_content = data.get("document")
-                images = data.get("images", [])
-
-            if not images and "images" in data:  # <- add these two lines
-                images = data["images"]  # <-
-
-            if not doc_content:
-                return abort(
-                    400, "Missing document content in body.$content or document"
-                )
+                images = data.get("images") or []
 
             if not doc_content:
                 return (
@@ -835,23 +1090,17 @@ class DOCXFormatterAPI:
 
             # Decode document content
             if isinstance(doc_content, str):
-                doc_bytes = base64.b64decode(doc_content)
+                doc_bytes = _b64decode(doc_content)
             else:
                 doc_bytes = doc_content
 
             # Log where we found the data
-            if "body" in data and "images" in data.get("body", {}):
+            if body_is_dict and "images" in body:
                 logger.info(f"Found images in body.images: {len(images)} images")
             else:
                 logger.info(f"Found images at root level: {len(images)} images")
 
-            # First, format the document for text markers
-            input_stream = io.BytesIO(doc_bytes)
-            formatted_stream = self.formatter.format_document(input_stream)
-            formatted_bytes = formatted_stream.read()
-
-            # Then, add images if any
-            if images:
+            if images and logger.isEnabledFor(logging.INFO):
                 logger.info(f"Processing {len(images)} images")
                 # Log the image markers for debugging
                 for img in images:
@@ -859,19 +1108,19 @@ class DOCXFormatterAPI:
                         f"Image marker: {img.get('marker')}, format: {img.get('format')}, size: {img.get('width')}x{img.get('height')}"
                     )
 
-                result_bytes = self.image_handler.add_images_to_docx(
-                    formatted_bytes, images
-                )
+            # Format text markers and add images in a single load/save
+            result_stream = self.formatter.format_and_add_images(
+                io.BytesIO(doc_bytes), images
+            )
+            if images:
                 logger.info("Image processing completed")
-            else:
-                result_bytes = formatted_bytes
 
             # Return response
             response_data = {
                 "status": "success",
                 "body": {
                     "$content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    "$content": base64.b64encode(result_bytes).decode("utf-8"),
+                    "$content": _b64encode_str(result_stream.getbuffer()),
                 },
                 "images_processed": len(images),
             }
@@ -895,43 +1144,38 @@ class DOCXFormatterAPI:
 
         # Check Content-Type
         content_type = request.headers.get("Content-Type", "")
-        if not content_type.startswith("application/json"):
+        if not content_type.startswith(self.JSON_CONTENT_TYPE):
             logger.warning(
                 f"Invalid Content-Type for /format-with-images-download: {content_type}"
             )
             return abort(415, "Content-Type must be application/json")
 
+        # Read outside the try so 400/413 aborts aren't turned into 500s
+        data = self._read_json_body()
+        if not data:
+            return abort(400, "Request body must be valid JSON")
+
         try:
-            # Get JSON data from request
-            data = request.get_json()
 
-            if not data:
-                return abort(400, "Request body must be valid JSON")
+            body = data.get("body") if isinstance(data, dict) else None
+            body_is_dict = isinstance(body, dict)
 
             # Debug logging
-            logger.debug(f"Received data keys: {list(data.keys())}")
-            if "body" in data:
-                logger.debug(f"Body keys: {list(data['body'].keys())}")
-                if "images" in data["body"]:
-                    logger.debug(
-                        f"Number of images in body: {len(data['body']['images'])}"
-                    )
-
-            # Extract document and images
-            # Support multiple formats for flexibility
-            doc_content = None
-            images = []
-
-            # Format 1: Body structure with images inside body (NEW FORMAT)
-            if "body" in data and isinstance(data["body"], dict):
-                doc_content = data["body"].get("$content")
-                images = data["body"].get("images", [])
-            elif "document" in data:  # legacy support
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received data keys: {list(data)}")
+                if body_is_dict:
+                    logger.debug(f"Body keys: {list(body)}")
+                    if "images" in body:
+                        logger.debug(f"Number of images in body: {len(body['images'])}")
+
+            # Extract document and images: body.$content with body.images (NEW
+            # FORMAT, root-level images also accepted) or legacy root "document"
+            if body_is_dict:
+                doc_content = body.get("$content")
+                images = body.get("images") or data.get("images") or []
+            else:
                 doc_content = data.get("document")
-                images = data.get("images", [])
-
-            if not images and "images" in data:  # <- add these two lines
-                images = data["images"]  # <-
+                images = data.get("images") or []
 
             if not doc_content:
                 return abort(
@@ -940,23 +1184,17 @@ class DOCXFormatterAPI:
 
             # Decode document content
             if isinstance(doc_content, str):
-                doc_bytes = base64.b64decode(doc_content)
+                doc_bytes = _b64decode(doc_content)
             else:
                 doc_bytes = doc_content
 
             # Log where we found the data
-            if "body" in data and "images" in data.get("body", {}):
+            if body_is_dict and "images" in body:
                 logger.info(f"Found images in body.images: {len(images)} images")
             else:
                 logger.info(f"Found images at root level: {len(images)} images")
 
-            # First, format the document for text markers
-            input_stream = io.BytesIO(doc_bytes)
-            formatted_stream = self.formatter.format_document(input_stream)
-            formatted_bytes = formatted_stream.read()
-
-            # Then, add images if any
-            if images:
+            if images and logger.isEnabledFor(logging.INFO):
                 logger.info(f"Processing {len(images)} images")
                 # Log the image markers for debugging
                 for img in images:
@@ -964,27 +1202,20 @@ class DOCXFormatterAPI:
                         f"Image marker: {img.get('marker')}, format: {img.get('format')}, size: {img.get('width')}x{img.get('height')}"
                     )
 
-                result_bytes = self.image_handler.add_images_to_docx(
-                    formatted_bytes, images
-                )
+            # Format text markers and add images in a single load/save
+            result_stream = self.formatter.format_and_add_images(
+                io.BytesIO(doc_bytes), images
+            )
+            if images:
                 logger.info("Image processing completed")
-            else:
-                result_bytes = formatted_bytes
-
-            # Create output stream
-            output_stream = io.BytesIO(result_bytes)
-            output_stream.seek(0)
 
             logger.info(
                 f"Formatting completed with {len(images)} images (download mode)"
             )
 
             # Return as downloadable file
-            return send_file(
-                output_stream,
-                mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                as_attachment=True,
-                download_name="formatted_document_with_images.docx",
+            return self._send_docx_file(
+                result_stream, "formatted_document_with_images.docx"
             )
 
         except ValueError as ve:
@@ -1009,27 +1240,22 @@ class DOCXFormatterAPI:
             file = request.files["file"]
             if file.filename == "":
                 return abort(400, "No file selected")
-            file_data = file.read()
+            file_data = file.stream
         # Otherwise, assume binary upload (from Postman)
-        elif request.data:
-            file_data = request.data
         else:
-            return abort(400, "No file data received")
+            file_data = self._spool_request_body()
+            if file_data is None:
+                return abort(400, "No file data received")
 
         try:
             # Process document
-            input_stream = io.BytesIO(file_data)
-            output_stream = self.formatter.format_document(input_stream)
+            with file_data:
+                output_stream = self.formatter.format_document(file_data)
 
             logger.info("Formatting completed successfully (download mode)")
 
             # Return as downloadable file
-            return send_file(
-                output_stream,
-                mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                as_attachment=True,
-                download_name="formatted_document.docx",
-            )
+            return self._send_docx_file(output_stream, "formatted_document.docx")
 
         except ValueError as ve:
             logger.error(f"Formatting error: {ve}")
@@ -1039,35 +1265,52 @@ class DOCXFormatterAPI:
             return abort(500, "Internal server error during document processing")
 
     def format_xml_endpoint(self):
-        """XML response endpoint for testing"""
+        """
+        XML response endpoint for testing
+
+        Pass ?raw=1 to receive the formatted DOCX itself instead of the
+        base64 XML envelope.
+        """
         logger.info("Received formatting request (XML mode)")
 
         # Validate request
-        if not request.data:
+        upload = self._spool_request_body()
+        if upload is None:
             return self._xml_error("Empty request body")
 
         try:
             # Process document
-            input_stream = io.BytesIO(request.data)
-            output_stream = self.formatter.format_document(input_stream)
+            with upload:
+                output_stream = self.formatter.format_document(upload)
 
-            # Read output for base64 encoding
-            output_data = output_stream.read()
+            if request.args.get("raw") == "1":
+                logger.info("Formatting completed successfully (XML mode, raw)")
+                return self._send_docx_file(output_stream, "formatted_document.docx")
 
-            # Create XML response
-            xml_response = f"""<?xml version="1.0" encoding="UTF-8"?>
-<response>
-    <status>success</status>
-    <message>Document formatted successfully</message>
-    <document>
-        <contentType>application/vnd.openxmlformats-officedocument.wordprocessingml.document</contentType>
-        <encoding>base64</encoding>
-        <content>{base64.b64encode(output_data).decode('utf-8')}</content>
-    </document>
-</response>"""
+            # Stream the base64 body in chunks; neither the encoded document
+            # nor the XML envelope is ever held in memory as a whole
+            data = output_stream.getbuffer()
+            encoded_length = (len(data) + 2) // 3 * 4
+
+            def generate():
+                yield _XML_SUCCESS_PREFIX
+                for start in range(0, len(data), self.XML_ENCODE_CHUNK_SIZE):
+                    yield _b64encode(data[start : start + self.XML_ENCODE_CHUNK_SIZE])
+                yield _XML_SUCCESS_SUFFIX
 
             logger.info("Formatting completed successfully (XML mode)")
-            return xml_response, 200, {"Content-Type": "application/xml"}
+            return Response(
+                generate(),
+                200,
+                headers={
+                    "Content-Type": "application/xml",
+                    "Content-Length": str(
+                        len(_XML_SUCCESS_PREFIX)
+                        + encoded_length
+                        + len(_XML_SUCCESS_SUFFIX)
+                    ),
+                },
+            )
 
         except ValueError as ve:
             return self._xml_error(str(ve))
@@ -1075,17 +1318,128 @@ class DOCXFormatterAPI:
             logger.error(f"Unexpected error: {e}", exc_info=True)
             return self._xml_error("Internal server error")
 
+    def _send_docx_file(self, output_stream: BinaryIO, download_name: str):
+        """
+        Send a formatted DOCX from memory as an attachment.
+
+        The document is already a BytesIO, so it is served as-is (werkzeug
+        takes the Content-Length from the buffer) with no temp file to write
+        and clean up per download.
+        """
+        output_stream.seek(0)
+        return send_file(
+            output_stream,
+            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+        )
+
+    def _spool_request_body(self) -> Optional[BinaryIO]:
+        """
+        Copy the raw request body into a spooled temporary file.
+
+        Avoids holding the upload twice (request.data plus a BytesIO copy);
+        small uploads stay in memory, large ones spill to disk. Bodies sent
+        with ``Content-Encoding: gzip`` or ``deflate`` are decompressed on the
+        way in.
+
+        Returns:
+            Seekable stream positioned at the start, or None if the body is empty
+        """
+        upload = tempfile.SpooledTemporaryFile(max_size=self.UPLOAD_SPOOL_SIZE)
+        encoding = request.headers.get("Content-Encoding", "").strip().lower()
+        try:
+            if encoding in ("gzip", "x-gzip", "deflate"):
+                self._decompress_body(request.stream, upload, encoding)
+            else:
+                shutil.copyfileobj(request.stream, upload)
+        except BaseException:
+            upload.close()
+            raise
+        if upload.tell() == 0:
+            upload.close()
+            return None
+        upload.seek(0)
+        return upload
+
+    def _decompress_body(self, source: BinaryIO, target: BinaryIO, encoding: str):
+        """Inflate a compressed request body into target, capped at max_content_length"""
+        total = 0
+        try:
+            for chunk in self._inflate_chunks(source, encoding):
+                total += len(chunk)
+                if total > max_content_length:
+                    logger.warning("Decompressed request body exceeds size limit")
+                    abort(413, "Decompressed request body is too large")
+                target.write(chunk)
+        except (OSError, EOFError, zlib.error) as e:
+            logger.warning(f"Could not decompress {encoding} request body: {e}")
+            abort(400, f"Request body is not valid {encoding} data")
+
+    def _inflate_chunks(self, source: BinaryIO, encoding: str):
+        """Yield decompressed chunks of at most DECOMPRESS_CHUNK_SIZE bytes"""
+        size = self.DECOMPRESS_CHUNK_SIZE
+        if encoding == "deflate":
+            chunk = source.read(size)
+            if not chunk:
+                return
+            # "deflate" means zlib-wrapped data, but some clients send a raw
+            # deflate stream; the two-byte zlib header tells them apart
+            wbits = zlib.MAX_WBITS if _has_zlib_header(chunk) else -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+            while chunk:
+                # Bound the output per call so a small bomb can't expand at once
+                while chunk:
+                    yield decompressor.decompress(chunk, size)
+                    chunk = decompressor.unconsumed_tail
+                chunk = source.read(size)
+            yield decompressor.flush()
+            if not decompressor.eof:
+                raise EOFError("Compressed data ended before the end-of-stream marker")
+        else:
+            with gzip.GzipFile(fileobj=source, mode="rb") as gz:
+                yield from iter(lambda: gz.read(size), b"")
+
+    def _read_json_body(self):
+        """
+        Parse the JSON request body without caching the raw bytes on the request
+
+        Returns:
+            Parsed JSON value, or None if the body is empty or not valid JSON
+        """
+        # O(1) size check before anything is read or decoded
+        content_length = request.content_length
+        if content_length is not None and content_length > max_content_length:
+            logger.warning(f"Rejecting {content_length}-byte JSON request body")
+            abort(413, "Request body is too large")
+
+        raw = request.get_data(cache=False)
+        if not raw:
+            return None
+        try:
+            return _json_loads(raw)
+        except ValueError:
+            return None
+
     def _xml_error(self, message: str):
         """Return XML error response"""
-        xml_response = f"""<?xml version="1.0" encoding="UTF-8"?>
-<response>
-    <status>error</status>
-    <message>{message}</message>
-</response>"""
+        xml_response = (
+            _XML_ERROR_PREFIX + escape(message).encode("utf-8") + _XML_ERROR_SUFFIX
+        )
         return xml_response, 400, {"Content-Type": "application/xml"}
 
     def test_images_endpoint(self):
-        """Test endpoint to create a document with image markers - NEW ENDPOINT"""
+        """Test endpoint to download a document with image markers - NEW ENDPOINT"""
+        return send_file(
+            io.BytesIO(self._test_images_docx),
+            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            as_attachment=True,
+            download_name="test_document_with_image_markers.docx",
+        )
+
+    def _build_test_images_docx(self) -> bytes:
+        """Build the image-marker test document (served by /test-images)"""
         doc = Document()
 
         # Add title
@@ -1106,17 +1460,10 @@ class DOCXFormatterAPI:
             "{{BOLD_START}}Bold text{{BOLD_END}} followed by {{IMAGE:inline_image}}"
         )
 
-        # Save to stream
+        # Save to bytes
         output = io.BytesIO()
         doc.save(output)
-        output.seek(0)
-
-        return send_file(
-            output,
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            as_attachment=True,
-            download_name="test_document_with_image_markers.docx",
-        )
+        return output.getvalue()
 
     def test_document_markers_endpoint(self):
         """Debug endpoint to check what markers are in a document"""
@@ -1124,118 +1471,110 @@ class DOCXFormatterAPI:
 
         # Check Content-Type
         content_type = request.headers.get("Content-Type", "")
-        if not content_type.startswith("application/json"):
-            return (
-                jsonify(
-                    {
-                        "status": "error",
-                        "message": "Content-Type must be application/json",
-                    }
-                ),
+        if not content_type.startswith(self.JSON_CONTENT_TYPE):
+            return _json_response(
+                {
+                    "status": "error",
+                    "message": "Content-Type must be application/json",
+                },
                 415,
             )
 
+        # Get JSON data (outside the try so a 413 isn't a 500)
+        data = self._read_json_body()
+
         try:
-            # Get JSON data
-            data = request.get_json()
             if not data:
-                return (
-                    jsonify(
-                        {
-                            "status": "error",
-                            "message": "Request body must be valid JSON",
-                        }
-                    ),
+                return _json_response(
+                    {
+                        "status": "error",
+                        "message": "Request body must be valid JSON",
+                    },
                     400,
                 )
 
             # Extract document content
             doc_content = None
-            if "body" in data and isinstance(data["body"], dict):
-                if "$content" in data["body"]:
-                    doc_content = data["body"]["$content"]
+            body = data.get("body") if isinstance(data, dict) else None
+            if isinstance(body, dict):
+                doc_content = body.get("$content")
             elif "document" in data:
                 doc_content = data.get("document")
 
             if not doc_content:
-                return (
-                    jsonify({"status": "error", "message": "Missing document content"}),
-                    400,
+                return _json_response(
+                    {"status": "error", "message": "Missing document content"}, 400
                 )
 
-            # Decode document
-            doc_bytes = base64.b64decode(doc_content)
-            doc = Document(io.BytesIO(doc_bytes))
+            # Decode document; only the main part's XML is needed for the scan,
+            # so skip loading the whole package with python-docx. parse_xml
+            # still gives python-docx's element classes, so paragraph text
+            # matches Paragraph.text (tabs and breaks as \t and \n).
+            doc_bytes = _b64decode(doc_content)
+            try:
+                with zipfile.ZipFile(io.BytesIO(doc_bytes)) as z:
+                    document_xml = z.read("word/document.xml")
+                doc_body = parse_xml(document_xml).find(f"{W_NS}body")
+            except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError) as e:
+                logger.warning(f"Could not read document for marker check: {e}")
+                return _json_response(
+                    {"status": "error", "message": "Invalid DOCX file format"}, 400
+                )
 
-            # Find all image markers
+            # Find all image markers, collecting the unique names as we go
             markers_found = []
-            import re
-
-            image_pattern = re.compile(r"\{\{IMAGE:([^}]+)\}\}")
-
-            # Check all paragraphs
-            for para in doc.paragraphs:
-                text = para.text
-                matches = image_pattern.findall(text)
-                for match in matches:
-                    markers_found.append(
-                        {
-                            "marker": match,
-                            "full_marker": f"{{{{IMAGE:{match}}}}}",
-                            "paragraph": (
-                                text[:100] + "..." if len(text) > 100 else text
-                            ),
-                        }
-                    )
-
-            # Check tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        for para in cell.paragraphs:
-                            text = para.text
-                            matches = image_pattern.findall(text)
-                            for match in matches:
-                                markers_found.append(
-                                    {
-                                        "marker": match,
-                                        "full_marker": f"{{{{IMAGE:{match}}}}}",
-                                        "in_table": True,
-                                        "paragraph": (
-                                            text[:100] + "..."
-                                            if len(text) > 100
-                                            else text
-                                        ),
-                                    }
-                                )
-
-            return (
-                jsonify(
-                    {
-                        "status": "success",
-                        "markers_found": markers_found,
-                        "total_markers": len(markers_found),
-                        "unique_markers": list(set(m["marker"] for m in markers_found)),
+            unique_markers = set()
+
+            def scan(para_elem, in_table):
+                text = para_elem.text
+                if "{{" not in text:
+                    return
+                snippet = text[:100] + "..." if len(text) > 100 else text
+                for match in _IMAGE_MARKER_PATTERN.findall(text):
+                    unique_markers.add(match)
+                    found = {
+                        "marker": match,
+                        "full_marker": f"{{{{IMAGE:{match}}}}}",
+                        "paragraph": snippet,
                     }
-                ),
+                    if in_table:
+                        found["in_table"] = True
+                    markers_found.append(found)
+
+            # Check all top-level paragraphs, then the cells of top-level tables
+            for para in doc_body.iterchildren(W_P):
+                scan(para, False)
+            for table in doc_body.iterchildren(W_TBL):
+                for row in table.iterchildren(W_TR):
+                    for cell in row.iterchildren(W_TC):
+                        for para in cell.iterchildren(W_P):
+                            scan(para, True)
+
+            return _json_response(
+                {
+                    "status": "success",
+                    "markers_found": markers_found,
+                    "total_markers": len(markers_found),
+                    "unique_markers": list(unique_markers),
+                },
                 200,
             )
 
         except Exception as e:
             logger.error(f"Error checking markers: {e}", exc_info=True)
-            return jsonify({"status": "error", "message": str(e)}), 500
+            return _json_response({"status": "error", "message": str(e)}, 500)
 
     def test_json_structure_endpoint(self):
         """Test endpoint to verify JSON structure is being received correctly"""
         logger.info("Testing JSON structure")
 
         try:
-            # Get raw data first
-            raw_data = request.get_data(as_text=True)
+            # Read the raw bytes once, uncached and undecoded, and parse those
+            raw_data = request.get_data(cache=False)
             logger.info(f"Raw data length: {len(raw_data)}")
 
             # Try to parse JSON
-            data = request.get_json()
+            data = _json_loads(raw_data)
 
             result = {
                 "status": "success",
@@ -1274,19 +1613,25 @@ class DOCXFormatterAPI:
                     else "Not a list"
                 )
 
-            return jsonify(result), 200
+            return _json_response(result, 200)
 
         except Exception as e:
             logger.error(f"Error testing JSON: {e}", exc_info=True)
-            return (
-                jsonify(
-                    {"status": "error", "message": str(e), "type": type(e).__name__}
-                ),
-                500,
+            return _json_response(
+                {"status": "error", "message": str(e), "type": type(e).__name__}, 500
             )
 
     def create_test_document(self):
         """Create a test DOCX with formatting markers"""
+        return send_file(
+            io.BytesIO(self._test_markers_docx),
+            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            as_attachment=True,
+            download_name="test_document_with_markers.docx",
+        )
+
+    def _build_test_markers_docx(self) -> bytes:
+        """Build the formatting-marker test document (served by /test-doc)"""
         doc = Document()
 
         # Add title
@@ -1354,17 +1699,10 @@ class DOCXFormatterAPI:
             "This formatter preserves both structures. If content appears merged, check which type you used."
         )
 
-        # Save to stream
+        # Save to bytes
         output = io.BytesIO()
         doc.save(output)
-        output.seek(0)
-
-        return send_file(
-            output,
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            as_attachment=True,
-            download_name="test_document_with_markers.docx",
-        )
+        return output.getvalue()
 
     def test_format_endpoint(self):
         """Test the formatting logic directly"""
@@ -1400,7 +1738,7 @@ class DOCXFormatterAPI:
                         }
                     )
 
-                return jsonify(
+                return _json_response(
                     {
                         "success": True,
                         "original": "Test: {{BOLD_START}}bold{{BOLD_END}} and {{HIGHLIGHT_START}}highlight{{HIGHLIGHT_END}}",
@@ -1411,11 +1749,13 @@ class DOCXFormatterAPI:
                     }
                 )
             else:
-                return jsonify({"success": False, "error": "No paragraphs in result"})
+                return _json_response(
+                    {"success": False, "error": "No paragraphs in result"}
+                )
 
         except Exception as e:
             logger.error(f"Test format error: {e}", exc_info=True)
-            return jsonify({"success": False, "error": str(e)})
+            return _json_response({"success": False, "error": str(e)})
 
     def test_linebreaks_endpoint(self):
         """Test line break handling specifically"""
@@ -1459,11 +1799,7 @@ class DOCXFormatterAPI:
                 break_count = 0
 
                 for i, run in enumerate(para.runs):
-                    run_elem = run._element
-                    w_ns = (
-                        "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
-                    )
-                    br_elems = run_elem.findall(f".//{w_ns}br")
+                    br_elems = _XP_BREAKS(run._element)
 
                     run_info = {
                         "index": i,
@@ -1485,7 +1821,7 @@ class DOCXFormatterAPI:
                     "2.5 Regular item",
                 ]
 
-                return jsonify(
+                return _json_response(
                     {
                         "success": True,
                         "original_text": "2.1 First item\\n2.2 Second item\\n{{HIGHLIGHT_START}}2.3 Highlighted item\\n2.4 Another highlighted item{{HIGHLIGHT_END}}\\n2.5 Regular item",
@@ -1499,43 +1835,40 @@ class DOCXFormatterAPI:
                     }
                 )
 
-            return jsonify({"success": False, "error": "No paragraphs in result"})
+            return _json_response(
+                {"success": False, "error": "No paragraphs in result"}
+            )
 
         except Exception as e:
             logger.error(f"Line break test error: {e}", exc_info=True)
-            return jsonify({"success": False, "error": str(e)})
+            return _json_response({"success": False, "error": str(e)})
 
     def health_check(self):
         """Health check endpoint"""
-        return (
-            jsonify(
-                {
-                    "status": "healthy",
-                    "service": "docx-formatter",
-                    "features": [
-                        "text-formatting",
-                        "image-insertion",
-                    ],  # Added image feature
-                    "endpoints": [
-                        "/format",
-                        "/format-download",
-                        "/format-with-images",
-                        "/format-with-images-download",  # NEW endpoint listed
-                    ],
-                }
-            ),
+        return _json_response(
+            {
+                "status": "healthy",
+                "service": "docx-formatter",
+                "features": [
+                    "text-formatting",
+                    "image-insertion",
+                ],  # Added image feature
+                "endpoints": [
+                    "/format",
+                    "/format-download",
+                    "/format-with-images",
+                    "/format-with-images-download",  # NEW endpoint listed
+                ],
+            },
             200,
         )
 
     def _is_valid_content_type(self, content_type: str) -> bool:
         """Check if content type is valid for DOCX"""
-        valid_types = [
-            "application/octet-stream",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            "multipart/form-data",  # For browser uploads
-            "application/json",  # For JSON requests with images
-        ]
-        return any(content_type.startswith(vt) for vt in valid_types)
+        # Compare the bare media type, ignoring parameters such as charset or
+        # boundary and the header's letter case
+        media_type = (content_type or "").split(";", 1)[0].strip().lower()
+        return media_type in self.VALID_CONTENT_TYPES
 
     def run(self, host="0.0.0.0", port=5000, debug=False):
         """Run the Flask application"""
@@ -1545,61 +1878,91 @@ class DOCXFormatterAPI:
         if debug:
             self.app.run(host=host, port=port, debug=debug)
         else:
+            # GUNICORN=1 on Linux/Mac: replace this process with pre-forked
+            # gunicorn workers configured by gunicorn_conf.py
+            if os.environ.get("GUNICORN") == "1" and os.name == "posix":
+                self._exec_gunicorn(host, port)
+
             # Use waitress for Windows or gunicorn for Linux/Mac
             try:
                 from waitress import serve
 
-                serve(self.app, host=host, port=port)
+                # Waitress defaults to 4 threads; use at least one per core.
+                # channel_timeout matches gunicorn's timeout for slow requests.
+                serve(
+                    self.app,
+                    host=host,
+                    port=port,
+                    threads=max(4, os.cpu_count() or 1),
+                    channel_timeout=120,
+                )
             except ImportError:
                 logger.warning(
                     "Waitress not installed, falling back to Flask dev server"
                 )
                 self.app.run(host=host, port=port, debug=False)
 
+    def _exec_gunicorn(self, host: str, port: int) -> None:
+        """Exec gunicorn with gunicorn_conf.py; returns only if that fails"""
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        args = [
+            "gunicorn",
+            "-c",
+            os.path.join(app_dir, "gunicorn_conf.py"),
+            "--chdir",
+            app_dir,
+            "-b",
+            f"{host}:{port}",
+            "app:app",
+        ]
+        logger.info(f"Starting gunicorn: {' '.join(args)}")
+        try:
+            os.execvp("gunicorn", args)
+        except OSError as e:
+            logger.warning(f"Could not start gunicorn ({e}), using waitress instead")
+
 
 # Create global instance for waitress-serve
 api = DOCXFormatterAPI()
 app = api.app  # Expose the Flask app instance for waitress-serve
 
 
-# Quick self-test
+# Quick self-test (python app.py --self-test)
+_SELF_TEST_TEXT = "Test {{BOLD_START}}bold{{BOLD_END}} and {{HIGHLIGHT_START}}highlight{{HIGHLIGHT_END}}"
+_SELF_TEST_EXPECTED = (
+    "Test ",
+    "{{BOLD_START}}",
+    "bold",
+    "{{BOLD_END}}",
+    " and ",
+    "{{HIGHLIGHT_START}}",
+    "highlight",
+    "{{HIGHLIGHT_END}}",
+    "",
+)
+
+
 def self_test():
     """Run a quick self-test of the formatter"""
-    formatter = DOCXFormatter()
-    test_text = "Test {{BOLD_START}}bold{{BOLD_END}} and {{HIGHLIGHT_START}}highlight{{HIGHLIGHT_END}}"
-    parts = formatter.marker_pattern.split(test_text)
+    parts = tuple(api.formatter.marker_pattern.split(_SELF_TEST_TEXT))
 
     if logger.level <= logging.DEBUG:
         print("=== FORMATTER SELF-TEST ===")
-        print(f"Test text: {test_text}")
-        print(f"Split parts: {parts}")
-        print(
-            f"Expected: ['Test ', '{{BOLD_START}}', 'bold', '{{BOLD_END}}', ' and ', '{{HIGHLIGHT_START}}', 'highlight', '{{HIGHLIGHT_END}}', '']"
-        )
+        print(f"Test text: {_SELF_TEST_TEXT}")
+        print(f"Split parts: {list(parts)}")
+        print(f"Expected: {list(_SELF_TEST_EXPECTED)}")
         print("===========================")
 
     # Verify the pattern works correctly
-    expected_parts = [
-        "Test ",
-        "{{BOLD_START}}",
-        "bold",
-        "{{BOLD_END}}",
-        " and ",
-        "{{HIGHLIGHT_START}}",
-        "highlight",
-        "{{HIGHLIGHT_END}}",
-        "",
-    ]
-    if parts != expected_parts:
-        logger.error(f"Self-test failed! Expected {expected_parts}, got {parts}")
+    if parts != _SELF_TEST_EXPECTED:
+        logger.error(
+            f"Self-test failed! Expected {list(_SELF_TEST_EXPECTED)}, got {list(parts)}"
+        )
         raise RuntimeError("Formatter self-test failed")
 
 
 # Create and run the API
 if __name__ == "__main__":
-    # Run self-test first
-    self_test()
-
     # When running directly with python app.py
     import sys
 
@@ -1607,4 +1970,9 @@ if __name__ == "__main__":
     if debug_mode:
         logger.setLevel(logging.DEBUG)
         logger.info("Running in DEBUG mode")
+
+    # The pattern check is opt-in so it doesn't delay startup
+    if "--self-test" in sys.argv:
+        self_test()
+
     api.run(debug=debug_mode)  # Set based on command line arg
@@ -1,12 +1,45 @@
-import os
+import copy
 import re
-import uuid
-import zipfile
-import tempfile
-import shutil
+from binascii import a2b_base64
 from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape
 from lxml import etree
-import base64
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part
+
+# Optional SIMD base64 decoder; binascii is used when it isn't installed
+try:
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    _b64decode = a2b_base64
+
+# <w:drawing> for an inline picture; filled in by _create_image_xml with
+# (cx, cy, docPr id, name, descr, cNvPr name, r:embed, cx, cy)
+DRAWING_TEMPLATE = (
+    b'<w:drawing xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+    b' xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"'
+    b' xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"'
+    b' xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"'
+    b' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    b'<wp:inline distT="0" distB="0" distL="0" distR="0">'
+    b'<wp:extent cx="%d" cy="%d"/>'
+    b'<wp:effectExtent l="0" t="0" r="0" b="0"/>'
+    b'<wp:docPr id="%d" name="%s" descr="%s"/>'
+    b'<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    b"<pic:pic>"
+    b'<pic:nvPicPr><pic:cNvPr id="0" name="%s"/><pic:cNvPicPr/></pic:nvPicPr>'
+    b'<pic:blipFill><a:blip r:embed="%s"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+    b'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="%d" cy="%d"/></a:xfrm>'
+    b'<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr>'
+    b"</pic:pic>"
+    b"</a:graphicData></a:graphic>"
+    b"</wp:inline>"
+    b"</w:drawing>"
+)
+
+# Partnames of existing numbered media, e.g. /word/media/image3.png
+MEDIA_IMAGE_RE = re.compile(r"/word/media/image(\d+)\.")
 
 
 class DOCXImageHandler:
@@ -19,270 +52,247 @@ class DOCXImageHandler:
             "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
             "pic": "http://schemas.openxmlformats.org/drawingml/2006/picture",
             "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
-            "rels": "http://schemas.openxmlformats.org/package/2006/relationships",
         }
 
-    def add_images_to_docx(self, docx_bytes: bytes, images: List[Dict]) -> bytes:
-        """
-        Add images to a DOCX file at marker positions
+        # Clark-notation names, built once instead of formatted on every call
+        ns = self.namespaces
+        self._P = f"{{{ns['w']}}}p"
+        self._R = f"{{{ns['w']}}}r"
+        self._RPR = f"{{{ns['w']}}}rPr"
+        self._T = f"{{{ns['w']}}}t"
+        self._XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
 
-        Args:
-            docx_bytes: The DOCX file as bytes
-            images: List of image dictionaries with marker, data, format, width, height, description
+        # Existing drawing ids, so inserted pictures get unique wp:docPr ids
+        self._doc_pr_ids = etree.XPath("//wp:docPr/@id", namespaces={"wp": ns["wp"]})
 
-        Returns:
-            Modified DOCX file as bytes
+    def add_images_to_document(self, document, images: List[Dict]):
         """
-        if not images:
-            return docx_bytes
-
-        # Create temp directory
-        temp_dir = tempfile.mkdtemp()
-
-        try:
-            # Save input to temp file and extract
-            temp_input = os.path.join(temp_dir, "input.docx")
-            with open(temp_input, "wb") as f:
-                f.write(docx_bytes)
-
-            # Extract DOCX
-            extract_dir = os.path.join(temp_dir, "extracted")
-            with zipfile.ZipFile(temp_input, "r") as zip_ref:
-                zip_ref.extractall(extract_dir)
+        Add images to an already loaded python-docx Document at marker positions
 
-            # Process images
-            self._process_images(extract_dir, images)
+        The image parts and relationships are added to the in-memory package,
+        so they are written out by the caller's single document.save().
 
-            # Repackage DOCX
-            output_path = os.path.join(temp_dir, "output.docx")
-            with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zip_out:
-                for root, dirs, files in os.walk(extract_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arc_path = os.path.relpath(file_path, extract_dir)
-                        arc_path = arc_path.replace(os.sep, "/")
-                        zip_out.write(file_path, arc_path)
-
-            # Read result
-            with open(output_path, "rb") as f:
-                result = f.read()
-
-            return result
-
-        finally:
-            # Clean up
-            shutil.rmtree(temp_dir)
-
-    def _process_images(self, extract_dir: str, images: List[Dict]):
-        """Process all images and insert them into the document"""
-        # Load existing relationships to get next ID
-        rels_path = os.path.join(extract_dir, "word", "_rels", "document.xml.rels")
-        tree = etree.parse(rels_path)
-        root = tree.getroot()
-
-        # Find highest relationship ID
-        max_id = 0
-        ns = self.namespaces["rels"]
-        for rel in root.findall(f".//{{{ns}}}Relationship"):
-            rel_id = rel.get("Id", "")
-            if rel_id.startswith("rId"):
-                try:
-                    num = int(rel_id[3:])
-                    max_id = max(max_id, num)
-                except ValueError:
-                    pass
-
-        rel_counter = max_id + 1
+        Args:
+            document: python-docx Document to modify in place
+            images: List of image dictionaries with marker, data, format, width, height, description
+        """
+        records = self._prepare_images(images)
+        doc_part = document.part
+        package = doc_part.package
+
+        # Number new media after the highest existing imageN part
+        max_img = max(
+            (
+                int(m.group(1))
+                for m in (
+                    MEDIA_IMAGE_RE.match(part.partname) for part in package.iter_parts()
+                )
+                if m
+            ),
+            default=0,
+        )
+        img_counter = max_img + 1
 
-        # Find highest image number
-        max_img = 0
-        media_dir = os.path.join(extract_dir, "word", "media")
-        if os.path.exists(media_dir):
-            for filename in os.listdir(media_dir):
-                if filename.startswith("image"):
-                    try:
-                        num = int(re.search(r"image(\d+)", filename).group(1))
-                        max_img = max(max_img, num)
-                    except:
-                        pass
+        # Locate every marker's paragraphs in one pass over the document
+        marker_paras = self._index_marker_paragraphs(
+            document.element, [record[0] for record in records]
+        )
+        doc_pr_id = self._max_doc_pr_id(document.element) + 1
+
+        for (
+            marker,
+            img_bytes,
+            img_format,
+            width_emu,
+            height_emu,
+            description,
+        ) in records:
+            # Add the media part and relate it to the main document
+            content_type = (
+                "image/jpeg" if img_format == "jpg" else f"image/{img_format}"
+            )
+            partname = PackURI(f"/word/media/image{img_counter}.{img_format}")
+            img_part = Part(partname, content_type, img_bytes, package)
+            rel_id = doc_part.relate_to(img_part, RT.IMAGE)
+
+            # Insert image at the first paragraph still holding the marker
+            paras = marker_paras.get(marker)
+            if paras:
+                self._insert_image_at_marker(
+                    paras.pop(0),
+                    marker,
+                    rel_id,
+                    width_emu,
+                    height_emu,
+                    description,
+                    doc_pr_id,
+                )
+                doc_pr_id += 1
 
-        img_counter = max_img + 1
+            img_counter += 1
 
-        # Process each image
-        doc_path = os.path.join(extract_dir, "word", "document.xml")
-        doc_tree = etree.parse(doc_path)
-        doc_root = doc_tree.getroot()
+    def _prepare_images(
+        self, images: List[Dict]
+    ) -> List[Tuple[str, bytes, str, int, int, str]]:
+        """
+        Decode every image and resolve its settings before the XML is touched
 
+        Returns:
+            (marker, image bytes, format, width EMU, height EMU, description)
+            for each image, in request order
+        """
+        records = []
         for image_data in images:
-            marker = image_data.get("marker", "")
-            if not marker.startswith("{{IMAGE:"):
-                marker = f"{{{{IMAGE:{marker}}}}}"
-
-            # Decode image data
             img_bytes = image_data.get("data", "")
             if isinstance(img_bytes, str):
-                img_bytes = base64.b64decode(img_bytes)
-
-            # Save image file
-            os.makedirs(media_dir, exist_ok=True)
-            img_format = image_data.get("format", "png")
-            img_filename = f"image{img_counter}.{img_format}"
-            img_path = os.path.join(media_dir, img_filename)
-            with open(img_path, "wb") as f:
-                f.write(img_bytes)
-
-            # Add relationship
-            rel_id = f"rId{rel_counter}"
-            rel_elem = etree.SubElement(root, f"{{{ns}}}Relationship")
-            rel_elem.set("Id", rel_id)
-            rel_elem.set(
-                "Type",
-                "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image",
+                # Accept data URIs ("data:image/png;base64,...") as well
+                if img_bytes.startswith("data:"):
+                    img_bytes = img_bytes.partition(",")[2]
+                img_bytes = _b64decode(img_bytes)
+
+            # Convert pixels to EMUs
+            records.append(
+                (
+                    self._marker_for(image_data),
+                    img_bytes,
+                    image_data.get("format", "png"),
+                    image_data.get("width", 400) * 9525,
+                    image_data.get("height", 300) * 9525,
+                    image_data.get("description", "Image"),
+                )
             )
-            rel_elem.set("Target", f"media/{img_filename}")
+        return records
 
-            # Insert image at marker
-            self._insert_image_at_marker(
-                doc_root,
-                marker,
-                rel_id,
-                image_data.get("width", 400),
-                image_data.get("height", 300),
-                image_data.get("description", "Image"),
-            )
+    def _marker_for(self, image_data: Dict) -> str:
+        """Full {{IMAGE:...}} marker for an image entry (bare names are wrapped)"""
+        marker = image_data.get("marker", "")
+        if not marker.startswith("{{IMAGE:"):
+            marker = f"{{{{IMAGE:{marker}}}}}"
+        return marker
 
-            rel_counter += 1
-            img_counter += 1
+    def _index_marker_paragraphs(self, doc_root, markers: List[str]) -> Dict:
+        """
+        Map each marker to the paragraphs whose text contains it, in document order
 
-        # Save modified files
-        tree.write(rels_path, encoding="UTF-8", xml_declaration=True, pretty_print=True)
-        doc_tree.write(
-            doc_path, encoding="UTF-8", xml_declaration=True, pretty_print=True
+        Built once per request so each image is placed with a dict lookup
+        instead of another walk over the whole document.
+        """
+        # One alternation for all markers: a single scan per paragraph instead
+        # of a substring search per marker (longest first, so none shadows another)
+        pattern = re.compile(
+            "|".join(re.escape(m) for m in sorted(set(markers), key=len, reverse=True))
         )
 
-        # Ensure <Default Extension="png"...> etc. exists
-        ct_path = os.path.join(extract_dir, "[Content_Types].xml")
-        ct_tree = etree.parse(ct_path)
-        ct_root = ct_tree.getroot()
-        ext_exists = any(
-            el.get("Extension") == "png" for el in ct_root.findall("{*}Default")
+        index = {}
+        for para in doc_root.iter(self._P):
+            # Full paragraph text, so markers split across runs are found
+            full_txt = "".join(para.itertext(self._T, with_tail=False))
+            if "{{" not in full_txt:
+                continue
+            # Each paragraph is listed once per occurrence of a marker, so a
+            # marker repeated in one paragraph can take several images
+            for match in pattern.finditer(full_txt):
+                index.setdefault(match.group(), []).append(para)
+        return index
+
+    def _max_doc_pr_id(self, doc_root) -> int:
+        """Highest wp:docPr id already used in the document (0 if none)"""
+        return max(
+            (int(v) for v in self._doc_pr_ids(doc_root) if v.isdigit()), default=0
         )
-        if not ext_exists:
-            default = etree.SubElement(ct_root, "Default")
-            default.set("Extension", "png")
-            default.set("ContentType", "image/png")
-        ct_tree.write(ct_path, encoding="UTF-8", xml_declaration=True)
 
     def _insert_image_at_marker(
         self,
-        doc_root,
+        para,
         marker: str,
         rel_id: str,
-        width: int,
-        height: int,
+        width_emu: int,
+        height_emu: int,
         description: str,
+        doc_pr_id: int,
     ):
         """
-        Insert an image immediately after the *first* occurrence of `marker`
-        (even if that marker is split across multiple runs).
+        Remove the first occurrence of `marker` from the paragraph `para` (even
+        if that marker is split across multiple runs) and put the image in its
+        place. Other runs, their formatting and earlier images are left alone.
         """
-
-        ns_w = self.namespaces["w"]
-
-        # Walk every paragraph once – cheaper than scanning all <w:t> nodes individually
-        for para in doc_root.iter(f"{{{ns_w}}}p"):
-            # Build the full, contiguous paragraph text
-            texts = [t.text or "" for t in para.iter(f"{{{ns_w}}}t")]
-            full_txt = "".join(texts)
-
-            if marker not in full_txt:
-                continue  # no marker in this paragraph – next!
-
-            # ---------- 1. remove the marker text from all runs ----------
-            remaining = full_txt.replace(marker, "")
-            # Clear existing runs
-            for r in list(para.findall(f"{{{ns_w}}}r")):
-                para.remove(r)
-
-            # Re-add the paragraph text (without marker) in ONE run
-            r_new_txt = etree.SubElement(para, f"{{{ns_w}}}r")
-            t_elem = etree.SubElement(r_new_txt, f"{{{ns_w}}}t")
-            if remaining.startswith(" ") or remaining.endswith(" "):
-                t_elem.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
-            t_elem.text = remaining
-
-            # ---------- 2. drop in the image run right after ----------
-            img_run = etree.Element(f"{{{ns_w}}}r")
-            img_run.append(self._create_image_xml(rel_id, width, height, description))
-            para.append(img_run)
-
-            # Only insert once per document (remove `return` if you want every marker)
+        texts = [t for t in para.iter(self._T) if t.text]
+        full_txt = "".join(t.text for t in texts)
+        start = full_txt.find(marker)
+        if start < 0:
             return
-
-    def _create_image_xml(self, rel_id: str, width: int, height: int, description: str):
-        """Create the image XML structure"""
-        ns = self.namespaces
-
-        # Convert pixels to EMUs
-        width_emu = width * 9525
-        height_emu = height * 9525
-
-        # Build the drawing XML structure
-        drawing = etree.Element(f'{{{ns["w"]}}}drawing')
-
-        inline = etree.SubElement(drawing, f'{{{ns["wp"]}}}inline')
-        inline.set("distT", "0")
-        inline.set("distB", "0")
-        inline.set("distL", "0")
-        inline.set("distR", "0")
-
-        extent = etree.SubElement(inline, f'{{{ns["wp"]}}}extent')
-        extent.set("cx", str(width_emu))
-        extent.set("cy", str(height_emu))
-
-        effect_extent = etree.SubElement(inline, f'{{{ns["wp"]}}}effectExtent')
-        effect_extent.set("l", "0")
-        effect_extent.set("t", "0")
-        effect_extent.set("r", "0")
-        effect_extent.set("b", "0")
-
-        doc_pr = etree.SubElement(inline, f'{{{ns["wp"]}}}docPr')
-        doc_pr.set("id", str(uuid.uuid4().int % 100000))
-        doc_pr.set("name", description)
-        doc_pr.set("descr", description)
-
-        graphic = etree.SubElement(inline, f'{{{ns["a"]}}}graphic')
-        graphic_data = etree.SubElement(graphic, f'{{{ns["a"]}}}graphicData')
-        graphic_data.set(
-            "uri", "http://schemas.openxmlformats.org/drawingml/2006/picture"
+        end = start + len(marker)
+
+        # ---------- 1. cut the marker out of the w:t elements it spans ----------
+        offset = 0
+        for t_elem in texts:
+            text = t_elem.text
+            t_start, t_end = offset, offset + len(text)
+            offset = t_end
+            if t_end <= start:
+                continue
+            head = text[: max(start - t_start, 0)]
+            if t_end < end:
+                t_elem.text = head
+                continue
+            # This w:t holds the end of the marker: the image goes right here
+            tail = text[end - t_start :]
+            t_elem.text = head
+            break
+
+        # ---------- 2. drop in the image run, splitting the run if needed ----------
+        run = t_elem.getparent()
+        img_run = etree.Element(self._R)
+        img_run.append(
+            self._create_image_xml(
+                rel_id, width_emu, height_emu, description, doc_pr_id
+            )
+        )
+        run.addnext(img_run)
+
+        # Whatever followed the marker in its run moves to a copy after the image
+        following = list(t_elem.itersiblings())
+        if tail or following:
+            tail_run = etree.Element(self._R)
+            rpr = run.find(self._RPR)
+            if rpr is not None:
+                tail_run.append(copy.deepcopy(rpr))
+            if tail:
+                tail_t = etree.SubElement(tail_run, self._T)
+                tail_t.text = tail
+                self._preserve_space(tail_t)
+            tail_run.extend(following)
+            img_run.addnext(tail_run)
+        self._preserve_space(t_elem)
+
+    def _preserve_space(self, t_elem):
+        """Mark a w:t as space-preserving when its text has edge whitespace"""
+        text = t_elem.text or ""
+        if text != text.strip():
+            t_elem.set(self._XML_SPACE, "preserve")
+
+    def _create_image_xml(
+        self,
+        rel_id: str,
+        width_emu: int,
+        height_emu: int,
+        description: str,
+        doc_pr_id: int,
+    ):
+        """Create the image XML structure (sizes in EMUs)"""
+        # Parse the whole drawing in one go instead of building it node by node
+        descr = escape(description, {'"': "&quot;"}).encode("utf-8")
+        return etree.fromstring(
+            DRAWING_TEMPLATE
+            % (
+                width_emu,
+                height_emu,
+                doc_pr_id,
+                descr,
+                descr,
+                descr,
+                rel_id.encode("ascii"),
+                width_emu,
+                height_emu,
+            )
         )
-
-        pic = etree.SubElement(graphic_data, f'{{{ns["pic"]}}}pic')
-
-        nv_pic_pr = etree.SubElement(pic, f'{{{ns["pic"]}}}nvPicPr')
-        c_nv_pr = etree.SubElement(nv_pic_pr, f'{{{ns["pic"]}}}cNvPr')
-        c_nv_pr.set("id", "0")
-        c_nv_pr.set("name", description)
-        c_nv_pic_pr = etree.SubElement(nv_pic_pr, f'{{{ns["pic"]}}}cNvPicPr')
-
-        blip_fill = etree.SubElement(pic, f'{{{ns["pic"]}}}blipFill')
-        blip = etree.SubElement(blip_fill, f'{{{ns["a"]}}}blip')
-        blip.set(f'{{{ns["r"]}}}embed', rel_id)
-
-        stretch = etree.SubElement(blip_fill, f'{{{ns["a"]}}}stretch')
-        fill_rect = etree.SubElement(stretch, f'{{{ns["a"]}}}fillRect')
-
-        sp_pr = etree.SubElement(pic, f'{{{ns["pic"]}}}spPr')
-        xfrm = etree.SubElement(sp_pr, f'{{{ns["a"]}}}xfrm')
-        off = etree.SubElement(xfrm, f'{{{ns["a"]}}}off')
-        off.set("x", "0")
-        off.set("y", "0")
-        ext = etree.SubElement(xfrm, f'{{{ns["a"]}}}ext')
-        ext.set("cx", str(width_emu))
-        ext.set("cy", str(height_emu))
-
-        prst_geom = etree.SubElement(sp_pr, f'{{{ns["a"]}}}prstGeom')
-        prst_geom.set("prst", "rect")
-        av_lst = etree.SubElement(prst_geom, f'{{{ns["a"]}}}avLst')
-
-        return drawing
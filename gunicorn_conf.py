@@ -0,0 +1,19 @@
+"""
+Gunicorn settings for production on Linux/macOS.
+
+Usage: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import os
+
+# DOCX formatting is CPU-bound Python, so scale with processes, not threads
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+worker_class = "sync"
+threads = 1
+
+# Import app.py once in the master; workers fork with the formatter ready
+preload_app = True
+
+# Large documents with many images can take a while to process
+timeout = 120
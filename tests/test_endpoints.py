@@ -0,0 +1,69 @@
+import gzip
+import io
+import unittest
+import zlib
+from unittest import mock
+
+from werkzeug.exceptions import BadRequest
+
+import app
+
+
+class FormatEndpointTests(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def test_wrong_media_type_is_rejected_before_the_body_is_read(self):
+        with mock.patch.object(app.api, "_spool_request_body") as spool:
+            response = self.client.post(
+                "/format", data=b"x" * 1024, headers={"Content-Type": "text/plain"}
+            )
+
+        self.assertEqual(response.status_code, 415)
+        spool.assert_not_called()
+
+    def test_empty_body_is_rejected(self):
+        response = self.client.post(
+            "/format", data=b"", headers={"Content-Type": "application/octet-stream"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class DecompressBodyTests(unittest.TestCase):
+    PAYLOAD = b"word/document.xml " * 4096
+
+    def decompress(self, body, encoding):
+        target = io.BytesIO()
+        app.api._decompress_body(io.BytesIO(body), target, encoding)
+        return target.getvalue()
+
+    def raw_deflate(self, data):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_zlib_wrapped_deflate(self):
+        body = zlib.compress(self.PAYLOAD)
+        self.assertEqual(self.decompress(body, "deflate"), self.PAYLOAD)
+
+    def test_raw_deflate(self):
+        body = self.raw_deflate(self.PAYLOAD)
+        self.assertEqual(self.decompress(body, "deflate"), self.PAYLOAD)
+
+    def test_truncated_deflate_is_rejected(self):
+        bodies = {
+            "zlib": zlib.compress(self.PAYLOAD),
+            "raw": self.raw_deflate(self.PAYLOAD),
+        }
+        for kind, body in bodies.items():
+            with self.subTest(kind=kind):
+                with self.assertRaises(BadRequest):
+                    self.decompress(body[: len(body) // 2], "deflate")
+
+    def test_truncated_gzip_is_rejected(self):
+        body = gzip.compress(self.PAYLOAD)
+        with self.assertRaises(BadRequest):
+            self.decompress(body[: len(body) // 2], "gzip")
+
+
+if __name__ == "__main__":
+    unittest.main()
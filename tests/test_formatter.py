@@ -0,0 +1,215 @@
+import io
+import unittest
+import zipfile
+
+from docx import Document
+from docx.oxml import parse_xml
+from lxml import etree
+
+from app import DOCXFormatter, W_NS_URI
+
+W = f"{{{W_NS_URI}}}"
+
+
+def make_paragraph(body: str):
+    """Build a <w:p> with python-docx element classes, as in a loaded document"""
+    return parse_xml(f'<w:p xmlns:w="{W_NS_URI}">{body}</w:p>')
+
+
+def run_props(run_elem):
+    """(bold, highlight, italic) of a run"""
+    rpr = run_elem.find(f"{W}rPr")
+    if rpr is None:
+        return False, None, False
+    highlight = rpr.find(f"{W}highlight")
+    return (
+        rpr.find(f"{W}b") is not None,
+        highlight.get(f"{W}val") if highlight is not None else None,
+        rpr.find(f"{W}i") is not None,
+    )
+
+
+def content(para):
+    """Flatten a paragraph into (text | "tab" | "br", bold, highlight, italic)"""
+    items = []
+    for run_elem in para.iterchildren(f"{W}r"):
+        props = run_props(run_elem)
+        for child in run_elem:
+            if child.tag == f"{W}t":
+                items.append((child.text,) + props)
+            elif child.tag in (f"{W}tab", f"{W}br"):
+                items.append((etree.QName(child).localname,) + props)
+    return items
+
+
+class ProcessXmlParagraphTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.formatter = DOCXFormatter()
+
+    def process(self, body: str):
+        para = make_paragraph(body)
+        self.assertTrue(self.formatter._process_xml_paragraph(para))
+        return para
+
+    def test_paragraph_without_markers_is_left_alone(self):
+        para = make_paragraph("<w:r><w:t>plain {text}</w:t></w:r>")
+        before = etree.tostring(para)
+        self.assertFalse(self.formatter._process_xml_paragraph(para))
+        self.assertEqual(etree.tostring(para), before)
+
+    def test_marker_split_across_runs(self):
+        para = self.process(
+            "<w:r><w:t>A {{BO</w:t></w:r>"
+            "<w:r><w:t>LD_START}}b{{BOLD_</w:t></w:r>"
+            '<w:r><w:t xml:space="preserve">END}} c</w:t></w:r>'
+        )
+        self.assertEqual(
+            content(para),
+            [
+                ("A ", False, None, False),
+                ("b", True, None, False),
+                (" c", False, None, False),
+            ],
+        )
+
+    def test_single_state_run_keeps_its_element_and_properties(self):
+        para = make_paragraph(
+            '<w:r><w:rPr><w:rFonts w:ascii="Arial"/></w:rPr>'
+            "<w:t>{{BOLD_START}}all{{BOLD_END}}</w:t></w:r>"
+        )
+        run_elem = para[0]
+        self.assertTrue(self.formatter._process_xml_paragraph(para))
+        self.assertIs(para[0], run_elem)
+        self.assertEqual(content(para), [("all", True, None, False)])
+        fonts = run_elem.find(f"{W}rPr/{W}rFonts")
+        self.assertEqual(fonts.get(f"{W}ascii"), "Arial")
+
+    def test_mixed_state_run_is_split_keeping_its_rpr(self):
+        para = self.process(
+            "<w:r><w:rPr><w:i/></w:rPr>"
+            "<w:t>x {{BOLD_START}}y{{BOLD_END}} z</w:t></w:r>"
+        )
+        self.assertEqual(
+            content(para),
+            [
+                ("x ", False, None, True),
+                ("y", True, None, True),
+                (" z", False, None, True),
+            ],
+        )
+
+    def test_marker_only_runs_are_removed(self):
+        para = self.process(
+            '<w:r><w:t xml:space="preserve">a </w:t></w:r>'
+            "<w:r><w:t>{{HIGHLIGHT_START}}</w:t></w:r>"
+            "<w:r><w:t>h</w:t></w:r>"
+            "<w:r><w:t>{{HIGHLIGHT_END}}</w:t></w:r>"
+        )
+        self.assertEqual(len(para.findall(f"{W}r")), 2)
+        self.assertEqual(
+            content(para), [("a ", False, None, False), ("h", False, "yellow", False)]
+        )
+
+    def test_tab_and_break_children_follow_the_state(self):
+        para = self.process(
+            "<w:r><w:rPr><w:i/></w:rPr>"
+            "<w:t>a{{BOLD_START}}b</w:t><w:tab/><w:t>c{{BOLD_END}}</w:t>"
+            "<w:br/><w:t>d</w:t></w:r>"
+        )
+        self.assertEqual(
+            content(para),
+            [
+                ("a", False, None, True),
+                ("b", True, None, True),
+                ("tab", True, None, True),
+                ("c", True, None, True),
+                ("br", False, None, True),
+                ("d", False, None, True),
+            ],
+        )
+
+    def test_tab_and_break_only_runs_take_the_active_state(self):
+        para = self.process(
+            "<w:r><w:t>{{BOLD_START}}a</w:t></w:r>"
+            "<w:r><w:tab/></w:r>"
+            "<w:r><w:t>b{{BOLD_END}} {{HIGHLIGHT_START}}c</w:t></w:r>"
+            "<w:r><w:br/></w:r>"
+            "<w:r><w:t>d{{HIGHLIGHT_END}}</w:t></w:r>"
+            "<w:r><w:tab/></w:r>"
+        )
+        self.assertEqual(
+            content(para),
+            [
+                ("a", True, None, False),
+                ("tab", True, None, False),
+                ("b", True, None, False),
+                (" ", False, None, False),
+                ("c", False, "yellow", False),
+                ("br", False, "yellow", False),
+                ("d", False, "yellow", False),
+                ("tab", False, None, False),
+            ],
+        )
+
+
+def rewrite_package(data: bytes, name: str, edit) -> bytes:
+    """Copy a DOCX package with edit(xml bytes) applied to one entry"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as zin, zipfile.ZipFile(
+        output, "w", zipfile.ZIP_DEFLATED
+    ) as zout:
+        for item in zin.infolist():
+            blob = zin.read(item)
+            zout.writestr(item, edit(blob) if item.filename == name else blob)
+    return output.getvalue()
+
+
+class FormatDocumentValidationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.formatter = DOCXFormatter()
+        document = Document()
+        document.add_paragraph("no markers here")
+        document.sections[0].header.paragraphs[0].text = "header"
+        stream = io.BytesIO()
+        document.save(stream)
+        cls.plain_docx = stream.getvalue()
+
+    def assert_invalid(self, data: bytes):
+        with self.assertRaisesRegex(ValueError, "Invalid DOCX file format"):
+            self.formatter.format_document(io.BytesIO(data))
+
+    def test_plain_document_is_returned_unchanged(self):
+        result = self.formatter.format_document(io.BytesIO(self.plain_docx))
+        self.assertEqual(result.read(), self.plain_docx)
+
+    def test_relationship_without_target_is_rejected(self):
+        def drop_header_target(xml):
+            rels = etree.fromstring(xml)
+            for rel in rels:
+                if rel.get("Type", "").endswith("/header"):
+                    del rel.attrib["Target"]
+            return etree.tostring(rels)
+
+        self.assert_invalid(
+            rewrite_package(
+                self.plain_docx, "word/_rels/document.xml.rels", drop_header_target
+            )
+        )
+
+    def test_malformed_document_without_markers_is_rejected(self):
+        self.assert_invalid(
+            rewrite_package(
+                self.plain_docx,
+                "word/document.xml",
+                lambda xml: xml.replace(b"</w:body>", b""),
+            )
+        )
+
+    def test_not_a_zip_is_rejected(self):
+        self.assert_invalid(b"not a docx")
+
+
+if __name__ == "__main__":
+    unittest.main()
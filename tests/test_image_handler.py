@@ -0,0 +1,114 @@
+import base64
+import unittest
+
+from docx import Document
+
+from docx_image_handler import DOCXImageHandler
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+def image(marker: str, description: str = "Image"):
+    return {
+        "marker": marker,
+        "data": base64.b64encode(PNG).decode(),
+        "description": description,
+    }
+
+
+def content(paragraph):
+    """Flatten a paragraph into its text pieces and ("img", descr) entries"""
+    items = []
+    for run_elem in paragraph._p.iterchildren(f"{W}r"):
+        for child in run_elem:
+            if child.tag == f"{W}t" and child.text:
+                items.append(child.text)
+            elif child.tag == f"{W}drawing":
+                doc_pr = next(child.iter("{*}docPr"))
+                items.append(("img", doc_pr.get("descr")))
+    return items
+
+
+class AddImagesToDocumentTests(unittest.TestCase):
+    def setUp(self):
+        self.handler = DOCXImageHandler()
+
+    def test_each_occurrence_of_a_repeated_marker_takes_one_image(self):
+        document = Document()
+        para = document.add_paragraph("y {{IMAGE:a}} z {{IMAGE:a}}")
+
+        self.handler.add_images_to_document(
+            document, [image("a", "first"), image("a", "second")]
+        )
+
+        self.assertEqual(
+            content(para), ["y ", ("img", "first"), " z ", ("img", "second")]
+        )
+
+    def test_extra_occurrences_without_an_image_are_left_in_place(self):
+        document = Document()
+        para = document.add_paragraph("{{IMAGE:a}} and {{IMAGE:a}}")
+
+        self.handler.add_images_to_document(document, [image("a")])
+
+        self.assertEqual(content(para), [("img", "Image"), " and {{IMAGE:a}}"])
+
+    def test_repeated_marker_across_paragraphs_fills_them_in_order(self):
+        document = Document()
+        first = document.add_paragraph("one {{IMAGE:a}}")
+        second = document.add_paragraph("two {{IMAGE:a}}")
+
+        self.handler.add_images_to_document(
+            document, [image("a", "first"), image("a", "second")]
+        )
+
+        self.assertEqual(content(first), ["one ", ("img", "first")])
+        self.assertEqual(content(second), ["two ", ("img", "second")])
+
+    def test_marker_split_across_runs_keeps_the_runs(self):
+        document = Document()
+        para = document.add_paragraph()
+        para.add_run("before {{IMA").bold = True
+        para.add_run("GE:c}} after")
+
+        self.handler.add_images_to_document(document, [image("c")])
+
+        self.assertEqual(content(para), ["before ", ("img", "Image"), " after"])
+        self.assertTrue(para.runs[0].bold)
+        self.assertIsNone(para.runs[-1].bold)
+
+    def test_earlier_image_in_the_paragraph_is_kept(self):
+        document = Document()
+        para = document.add_paragraph("{{IMAGE:a}} {{IMAGE:b}}")
+
+        self.handler.add_images_to_document(
+            document, [image("a", "first"), image("b", "second")]
+        )
+
+        self.assertEqual(content(para), [("img", "first"), " ", ("img", "second")])
+
+    def test_images_get_their_own_relationship_and_drawing_id(self):
+        document = Document()
+        document.add_paragraph("{{IMAGE:a}}{{IMAGE:a}}")
+
+        self.handler.add_images_to_document(document, [image("a"), image("a")])
+
+        body = document.element.body
+        embeds = [blip.get(f"{R}embed") for blip in body.iter(f"{A}blip")]
+        doc_pr_ids = [doc_pr.get("id") for doc_pr in body.iter("{*}docPr")]
+        self.assertEqual(len(set(embeds)), 2)
+        self.assertEqual(len(set(doc_pr_ids)), 2)
+        for rel_id in embeds:
+            self.assertEqual(
+                document.part.related_parts[rel_id].content_type, "image/png"
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import base64
+import io
+import unittest
+import zipfile
+import zlib
+from types import SimpleNamespace
+from unittest import mock
+
+from docx import Document
+
+import app
+
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+def document_with_image():
+    document = Document()
+    document.add_paragraph("picture {{BOLD_START}}below{{BOLD_END}}")
+    document.add_picture(io.BytesIO(PNG))
+    return document
+
+
+def save(document) -> bytes:
+    stream = io.BytesIO()
+    app._save_document(document, stream)
+    return stream.getvalue()
+
+
+class SaveDocumentTests(unittest.TestCase):
+    def assert_round_trips(self, data: bytes):
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertIsNone(z.testzip())
+        Document(io.BytesIO(data))
+
+    def test_media_is_stored_and_xml_deflated(self):
+        data = save(document_with_image())
+
+        self.assert_round_trips(data)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            types = {info.filename: info.compress_type for info in z.infolist()}
+        media = [name for name in types if name.startswith("word/media/")]
+        self.assertTrue(media)
+        for name in media:
+            self.assertEqual(types[name], zipfile.ZIP_STORED)
+        self.assertEqual(types["word/document.xml"], zipfile.ZIP_DEFLATED)
+
+    def test_same_entries_as_python_docx_save(self):
+        document = document_with_image()
+        expected = io.BytesIO()
+        document.save(expected)
+
+        with zipfile.ZipFile(expected) as z:
+            expected_names = z.namelist()
+        with zipfile.ZipFile(io.BytesIO(save(document))) as z:
+            self.assertEqual(z.namelist(), expected_names)
+
+    def test_falls_back_to_document_save_without_writer_internals(self):
+        with mock.patch.object(app, "PackageWriter", None):
+            data = save(document_with_image())
+
+        self.assert_round_trips(data)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            media = [i for i in z.infolist() if i.filename.startswith("word/media/")]
+        # python-docx's own writer deflates everything
+        self.assertEqual(media[0].compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_deflates_through_the_isal_compressor_when_available(self):
+        # zlib has the same compressobj interface as isal_zlib
+        compressobj = mock.Mock(side_effect=zlib.compressobj)
+        stub = SimpleNamespace(
+            Z_DEFAULT_COMPRESSION=zlib.Z_DEFAULT_COMPRESSION,
+            DEFLATED=zlib.DEFLATED,
+            compressobj=compressobj,
+        )
+        document = document_with_image()
+        with mock.patch.object(app, "isal_zlib", stub):
+            data = save(document)
+
+        self.assert_round_trips(data)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            deflated = [
+                info
+                for info in z.infolist()
+                if info.compress_type == zipfile.ZIP_DEFLATED
+            ]
+            self.assertEqual(compressobj.call_count, len(deflated))
+            compressobj.assert_called_with(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+            )
+            # The paragraph text survives the swapped-in compressor
+            self.assertIn(b"picture", z.read("word/document.xml"))
+        self.assertIs(zipfile.zlib, zlib)
+
+
+if __name__ == "__main__":
+    unittest.main()